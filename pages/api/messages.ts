@@ -4,6 +4,49 @@ import fs from 'fs';
 import path from 'path';
 
 let messages: Message[] = [];
+// Messages indexed by room, so fetching a room does not scan every other room
+let roomMessages: Record<string, Message[]> = {};
+// Changes every time the messages are deleted, so incremental clients know their cursor is stale
+let generation = Date.now().toString();
+// Long-poll requests waiting for a new message in each room
+let roomWaiters: Record<string, Array<() => void>> = {};
+// Longest a long-poll request is held
+const MAX_WAIT_MS = 30000;
+
+function wakeUp(roomIds: string[]) {
+  for (const roomId of roomIds) {
+    const waiters = roomWaiters[roomId] || [];
+    delete roomWaiters[roomId];
+    waiters.forEach(wake => wake());
+  }
+}
+
+// Resolves when a message is added to the room (or all are deleted), or after waitMs
+function waitForMessages(roomId: string, waitMs: number): Promise<void> {
+  return new Promise(resolve => {
+    const wake = () => {
+      clearTimeout(timer);
+      resolve();
+    };
+    const timer = setTimeout(() => {
+      roomWaiters[roomId] = (roomWaiters[roomId] || []).filter(waiter => waiter !== wake);
+      resolve();
+    }, waitMs);
+    (roomWaiters[roomId] = roomWaiters[roomId] || []).push(wake);
+  });
+}
+
+function getUpdate(roomId: string, cursor: number, clientGeneration: string | string[] | undefined) {
+  const room = roomMessages[roomId] || [];
+  // If messages were deleted since the client's last fetch, it must resync everything
+  const reset = cursor > room.length || (clientGeneration !== undefined && clientGeneration !== generation);
+  return {
+    messages: reset ? room : room.slice(cursor),
+    cursor: room.length,
+    generation,
+    reset,
+  };
+}
 
 // Function to extract mentions from the message content
 function extractMentions(content: string): string {
@@ -45,6 +88,9 @@ function appendToCSV(message: Message) {
 // Function to delete all messages
 function deleteAllMessages() {
   messages = [];
+  roomMessages = {};
+  generation = Date.now().toString();
+  wakeUp(Object.keys(roomWaiters));
   const conversationsDir = path.join(process.cwd(), 'conversations');
 
   // Delete all files in the conversations directory
@@ -55,17 +101,45 @@ function deleteAllMessages() {
   }
 }
 
-export default function handler(req: NextApiRequest, res: NextApiResponse) {
+export default async function handler(req: NextApiRequest, res: NextApiResponse) {
   if (req.method === 'GET') {
-    const { roomId } = req.query;
+    const { roomId, since, generation: clientGeneration, wait } = req.query;
     if (typeof roomId !== 'string') {
       return res.status(400).json({ error: 'Invalid room ID' });
     }
-    const roomMessages = messages.filter(msg => msg.roomId === roomId);
-    res.status(200).json(roomMessages);
+    const room = roomMessages[roomId] || [];
+    if (since === undefined) {
+      return res.status(200).json(room);
+    }
+
+    // Incremental fetch: "since" is the number of messages of the room the client already has
+    const cursor = typeof since === 'string' ? parseInt(since, 10) : NaN;
+    if (isNaN(cursor) || cursor < 0) {
+      return res.status(400).json({ error: 'Invalid cursor' });
+    }
+    let update = getUpdate(roomId, cursor, clientGeneration);
+    if (wait === undefined) {
+      return res.status(200).json(update);
+    }
+
+    // Long-poll: "wait" is the number of seconds to hold the request until there is a new message
+    const waitS = typeof wait === 'string' ? parseFloat(wait) : NaN;
+    if (isNaN(waitS) || waitS < 0) {
+      return res.status(400).json({ error: 'Invalid wait' });
+    }
+    if (update.messages.length === 0 && !update.reset) {
+      await waitForMessages(roomId, Math.min(waitS * 1000, MAX_WAIT_MS));
+      update = getUpdate(roomId, cursor, clientGeneration);
+    }
+    res.status(200).json({ ...update, longPoll: true });
   } else if (req.method === 'POST') {
     const newMessage: Message = req.body;
     messages.push(newMessage);
+    if (!roomMessages[newMessage.roomId]) {
+      roomMessages[newMessage.roomId] = [];
+    }
+    roomMessages[newMessage.roomId].push(newMessage);
+    wakeUp([newMessage.roomId]);
     // Append the new message to the room-specific CSV file
     appendToCSV(newMessage);
     res.status(201).json(newMessage);
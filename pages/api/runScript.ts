@@ -58,15 +58,30 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
       }
     }
 
+    // Make main.py reload the experiment description, only starting and stopping the changed bots
+    if (action === 'reload') {
+      if (!isLLMBot || !currentProcess) {
+        return res.status(400).json({ message: 'No LLMBot script currently running.' });
+      }
+      // Only signal the tracked process, the shards of --shards get the reload from their supervisor
+      if (!currentProcess.kill('SIGHUP')) {
+        console.error('Error reloading script: could not signal the process');
+        return res.status(500).json({ message: 'Error reloading script' });
+      }
+      return res.status(200).json({ message: 'Experiment description reloaded.' });
+    }
+
     if (action === 'start') {
       if (currentProcess) {
         return res.status(400).json({ message: 'A script is already running. Please stop it first.' });
       }
 
-      const fullCommand = command.replace(
+      const redirectedCommand = command.replace(
         '2>> output/error_logs/error_log.txt',
         `2>> ${errorLogDirectory}/error_log.txt`
       );
+      // main.py replaces the shell, so the tracked process is the one the reload signals
+      const fullCommand = isLLMBot ? `exec ${redirectedCommand}` : redirectedCommand;
 
       const newProcess = exec(fullCommand, (error, stdout, stderr) => {
         if (error) {
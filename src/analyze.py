@@ -0,0 +1,434 @@
+"""
+Offline analysis of a run from its recorded conversations (output/conversations/ROOM.csv) and the
+logs of its bots (output/logs/BOT.log, including rotated .gz files).
+
+Files are streamed in chunks of --chunksize lines, grouped into records (messages and log records
+can span several lines) and every chunk is reduced with vectorized pandas/NumPy operations into
+fixed-size histograms and totals, so memory stays bounded however large the logs are. Reports:
+- messages: per room and author, message rate and reply latency (time since the last message of
+  someone else) distribution
+- bots: per bot, LLM call durations and aborts
+- delays: per bot, simulated reading/writing delays: the characters read and written (from the
+  messages of its room) over the time the delays actually took, against READ_SPEED/WRITE_SPEED
+
+The tables are written to --output as Parquet (CSV if pyarrow is not installed), and compared with
+the tables of a previous run with --baseline.
+
+Usage: python3 src/analyze.py --output output/analysis/RUN_NAME [--speedup 10] [--baseline output/analysis/OTHER_RUN]
+"""
+import argparse
+import glob
+import gzip
+import itertools
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+from constants import READ_SPEED, WRITE_SPEED
+
+# Write the tables as Parquet if pyarrow is installed (pip install pyarrow), else as CSV
+try:
+    import pyarrow
+    import pyarrow.parquet
+    TABLE_FORMAT = "parquet"
+except ImportError:
+    pyarrow = None
+    TABLE_FORMAT = "csv"
+
+CHUNK_LINES = 200000
+# Histogram bins in seconds (log-spaced from 10ms to ~3h), quantiles are read from them
+SECONDS_BINS = np.concatenate([[0], np.logspace(-2, 4, 121)])
+CONVERSATION_TIMESTAMP_FORMAT = "%d/%m/%Y %H:%M:%S"
+LOG_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+LOG_RECORD_START = r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} - '
+PROMPT_PREFIX_CHARS = len("Message from : ")    # Read messages are prompts "Message from NAME: CONTENT"
+
+SLEEP_START = r'^Going to sleep for (?P<clamped>[-+.\deE]+)s \(clamped from (?P<requested>[-+.\deE]+)s\) due to Simulating (?P<kind>reading|writing)'
+SLEEP_END = r'^Completed sleeping for [-+.\deE]+s due to Simulating (?P<kind>reading|writing)'
+LLM_CALL = r'^LLM call lasted (?P<duration>[.\d]+)s'
+ABORT_MESSAGES = ("Aborting.", "for on_message")
+
+class Histograms:
+    """
+    Histograms of values over SECONDS_BINS, with their count, sum and max, by key.
+    """
+    def __init__(self):
+        self.counts: dict[tuple, np.ndarray] = {}
+        self.sums: dict[tuple, float] = {}
+        self.maxs: dict[tuple, float] = {}
+
+    def add(self, frame, keys, column):
+        frame = frame.dropna(subset=[column])
+        if frame.empty:
+            return
+        bins = np.clip(np.searchsorted(SECONDS_BINS, frame[column].to_numpy(), side='right') - 1, 0, len(SECONDS_BINS) - 2)
+        frame = frame.assign(bin=bins)
+        for key, counts in frame.groupby(keys + ["bin"]).size().groupby(level=list(range(len(keys)))):
+            key = key if isinstance(key, tuple) else (key,)
+            histogram = self.counts.setdefault(key, np.zeros(len(SECONDS_BINS) - 1, dtype=np.int64))
+            np.add.at(histogram, counts.index.get_level_values("bin").to_numpy(), counts.to_numpy())
+        for key, values in frame.groupby(keys)[column].agg(["sum", "max"]).iterrows():
+            key = key if isinstance(key, tuple) else (key,)
+            self.sums[key] = self.sums.get(key, 0) + values["sum"]
+            self.maxs[key] = max(self.maxs.get(key, 0), values["max"])
+
+    def summarize(self, key, prefix):
+        counts = self.counts.get(key)
+        if counts is None:
+            return {f"{prefix}_count": 0}
+        cumulative = np.cumsum(counts)
+        total = int(cumulative[-1])
+        summary = {f"{prefix}_count": total, f"{prefix}_mean_s": self.sums[key] / total}
+        for quantile in (50, 90, 99):
+            # Upper edge of the bin of the quantile
+            index = np.searchsorted(cumulative, total * quantile / 100)
+            summary[f"{prefix}_p{quantile}_s"] = min(SECONDS_BINS[index + 1], self.maxs[key])
+        summary[f"{prefix}_max_s"] = self.maxs[key]
+        return summary
+
+def open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+class RecordReader:
+    """
+    Reads the records of a text file (gzipped or not) as Series of strings, in chunks of about
+    chunksize lines. A record is a line matching start_pattern followed by the lines that do not
+    (e.g. a message containing newlines). Lines before the first record are counted in skipped_lines.
+    """
+    def __init__(self, path, start_pattern, chunksize, skip_header=False):
+        self.path = path
+        self.start_pattern = start_pattern
+        self.chunksize = chunksize
+        self.skip_header = skip_header
+        self.skipped_lines = 0
+
+    def __iter__(self):
+        pending = None  # Last record of the previous chunk, it may continue in this chunk
+        with open_text(self.path) as file:
+            if self.skip_header:
+                next(file, None)
+            while True:
+                lines = list(itertools.islice(file, self.chunksize))
+                if not lines:
+                    break
+                lines = pd.Series(lines, dtype=object).str.rstrip("\r\n")
+                starts = lines.str.match(self.start_pattern)
+                if pending is not None:
+                    lines = pd.concat([pd.Series([pending], dtype=object), lines], ignore_index=True)
+                    starts = pd.concat([pd.Series([True]), starts], ignore_index=True)
+                records = self.join_records(lines, starts)
+                if records.empty:
+                    continue
+                pending = records.iloc[-1]
+                if len(records) > 1:
+                    yield records.iloc[:-1]
+        if pending is not None:
+            yield pd.Series([pending], dtype=object)
+
+    def join_records(self, lines, starts):
+        ids = starts.cumsum()
+        self.skipped_lines += int((ids == 0).sum())
+        if starts.all():
+            return lines
+        lines, starts, ids = lines[ids > 0], starts[ids > 0], ids[ids > 0]
+        # Only the records with continuation lines are joined, the others are kept as they are
+        multiline = ids.isin(ids[~starts].unique())
+        joined = lines[multiline].groupby(ids[multiline]).agg("\n".join)
+        single = pd.Series(lines[~multiline].to_numpy(), index=ids[~multiline].to_numpy(), dtype=object)
+        return pd.concat([single, joined]).sort_index().reset_index(drop=True)
+
+class ConversationStats:
+    def __init__(self):
+        self.latencies = Histograms()
+        # (room, name) -> [messages, first time, last time, characters, characters of the prompts]
+        self.messages: dict[tuple, list] = {}
+        self.skipped_lines = 0
+        self.malformed_records = 0
+
+    def add_file(self, path, chunksize):
+        # Rows are roomId,name,email,content,timestamp,mentions where the content has no commas (they are
+        # replaced) but may have newlines, so a record starts with the room of the file and two fields
+        room_id = os.path.splitext(os.path.basename(path))[0]
+        reader = RecordReader(path, f'{re.escape(room_id)},[^,]*,[^,]*,', chunksize, skip_header=True)
+        last = None     # Last message of the previous chunk, with its reference time
+        for records in reader:
+            fields = records.str.split(",", n=3, expand=True).reindex(columns=range(4))
+            tail = fields[3].str.rsplit(",", n=2, expand=True).reindex(columns=range(3))
+            chunk = pd.DataFrame({
+                "roomId": fields[0],
+                "name": fields[1],
+                "chars": tail[0].str.len(),
+                "time": pd.to_datetime(tail[1], format=CONVERSATION_TIMESTAMP_FORMAT, errors="coerce"),
+            })
+            valid = chunk["name"].notna() & chunk["time"].notna()
+            self.malformed_records += int((~valid).sum())
+            chunk = chunk[valid]
+            if chunk.empty:
+                continue
+            chunk = chunk.assign(prompt_chars=chunk["chars"] + chunk["name"].str.len() + PROMPT_PREFIX_CHARS)
+            if last is not None:
+                chunk = pd.concat([last, chunk], ignore_index=True)
+
+            # A reply is the first message of a run of messages of the same author, its latency is
+            # the time since the last message of the previous run
+            reply = chunk["name"] != chunk["name"].shift()
+            reference = chunk["time"].shift().where(reply)
+            if last is not None:
+                reference.iloc[0] = last["reference"].iloc[0]
+            chunk = chunk.assign(reference=reference.ffill(), reply=reply)
+            new = chunk.iloc[1:] if last is not None else chunk
+            last = chunk.iloc[[-1]]
+
+            replies = new[new["reply"]]
+            replies = replies.assign(latency=(replies["time"] - replies["reference"]).dt.total_seconds())
+            self.latencies.add(replies, ["roomId", "name"], "latency")
+            groups = new.groupby(["roomId", "name"]).agg(
+                size=("time", "size"), first=("time", "min"), last=("time", "max"),
+                chars=("chars", "sum"), prompt_chars=("prompt_chars", "sum"))
+            for (room_id, name), group in groups.iterrows():
+                totals = self.messages.setdefault((room_id, name), [0, group["first"], group["last"], 0, 0])
+                totals[0] += group["size"]
+                totals[1] = min(totals[1], group["first"])
+                totals[2] = max(totals[2], group["last"])
+                totals[3] += group["chars"]
+                totals[4] += group["prompt_chars"]
+        self.skipped_lines += reader.skipped_lines
+
+    def find_author(self, bot):
+        """
+        (room, name) of the messages of a bot, given the name of its logger (ROOM_ROLE_NAME).
+        """
+        for room_id, name in self.messages:
+            if bot.startswith(f"{room_id}_") and bot.endswith(f"_{name}"):
+                return room_id, name
+        return None
+
+    def get_chars(self, bot):
+        """
+        Characters read by a bot (the prompts of the messages of the others in its room) and written
+        by it (its messages), or None if it has no messages.
+        """
+        author = self.find_author(bot)
+        if author is None:
+            return None
+        room_prompt_chars = sum(totals[4] for (room_id, _), totals in self.messages.items() if room_id == author[0])
+        own = self.messages[author]
+        return {"reading": room_prompt_chars - own[4], "writing": own[3]}
+
+    def to_frame(self, bot_names):
+        rows = []
+        authors = {self.find_author(bot) for bot in bot_names}
+        for (room_id, name), (count, first, last, *_) in sorted(self.messages.items()):
+            minutes = (last - first).total_seconds() / 60
+            rows.append({
+                "room": room_id,
+                "name": name,
+                "is_bot": (room_id, name) in authors,
+                "messages": count,
+                "messages_per_min": count / minutes if minutes > 0 else np.nan,
+                **self.latencies.summarize((room_id, name), "reply_latency"),
+            })
+        return pd.DataFrame(rows)
+
+class LogStats:
+    def __init__(self, speedup):
+        self.speedup = speedup
+        self.llm_durations = Histograms()
+        self.counts: dict[str, dict] = {}      # bot -> llm_calls, aborts
+        self.delays: dict[tuple, dict] = {}    # (bot, kind) -> totals
+        self.skipped_lines = 0
+        self.malformed_records = 0
+
+    def add_file(self, path, chunksize):
+        # Records start with the time, the lines of multi-line messages are part of the record
+        reader = RecordReader(path, LOG_RECORD_START, chunksize)
+        last_sleep = None   # Last sleep record of the previous chunk, to pair it with its end
+        for records in reader:
+            fields = records.str.split(" - ", n=3, expand=True).reindex(columns=range(4))
+            fields.columns = ["time", "bot", "level", "message"]
+            fields = fields.assign(time=pd.to_datetime(fields["time"], format=LOG_TIMESTAMP_FORMAT, errors="coerce"))
+            valid = fields["level"].isin(LOG_LEVELS) & fields["time"].notna() & fields["message"].notna()
+            self.malformed_records += int((~valid).sum())
+            fields = fields[valid]
+
+            self.add_llm_calls(fields)
+            self.add_aborts(fields)
+            last_sleep = self.add_sleeps(fields, last_sleep)
+        self.skipped_lines += reader.skipped_lines
+
+    def get_counts(self, bot):
+        return self.counts.setdefault(bot, {"llm_calls": 0, "aborts": 0})
+
+    def add_llm_calls(self, fields):
+        calls = fields[fields["message"].str.startswith("LLM call lasted")]
+        calls = calls.assign(duration=calls["message"].str.extract(LLM_CALL)["duration"].astype(float))
+        self.llm_durations.add(calls, ["bot"], "duration")
+        for bot, count in calls.groupby("bot").size().items():
+            self.get_counts(bot)["llm_calls"] += count
+
+    def add_aborts(self, fields):
+        errors = fields[fields["level"] == "ERROR"]
+        aborts = errors[errors["message"].str.endswith(ABORT_MESSAGES[0]) | errors["message"].str.contains(ABORT_MESSAGES[1], regex=False)]
+        for bot, count in aborts.groupby("bot").size().items():
+            self.get_counts(bot)["aborts"] += count
+
+    def add_sleeps(self, fields, last_sleep):
+        """
+        Pair every simulated reading/writing sleep with the line logged when it completed.
+        Returns the last sleep line, to pair it with the next chunk.
+        """
+        sleeps = fields[fields["message"].str.contains("due to Simulating", regex=False)]
+        if sleeps.empty:
+            return last_sleep
+        if last_sleep is not None:
+            sleeps = pd.concat([last_sleep, sleeps], ignore_index=True)
+        starts = sleeps["message"].str.extract(SLEEP_START)
+        ends = sleeps["message"].str.extract(SLEEP_END)
+        sleeps = sleeps.assign(clamped=starts["clamped"].astype(float), requested=starts["requested"].astype(float),
+                               start_kind=starts["kind"], end_kind=ends["kind"])
+
+        previous = sleeps.shift()
+        paired = sleeps["end_kind"].notna() & (previous["start_kind"] == sleeps["end_kind"]) & (previous["bot"] == sleeps["bot"])
+        pairs = pd.DataFrame({
+            "bot": sleeps["bot"][paired],
+            "kind": sleeps["end_kind"][paired],
+            "requested": previous["requested"][paired],
+            "clamped": previous["clamped"][paired],
+            "elapsed": (sleeps["time"] - previous["time"])[paired].dt.total_seconds(),
+        })
+        for (bot, kind), group in pairs.groupby(["bot", "kind"]):
+            totals = self.delays.setdefault((bot, kind), {"sleeps": 0, "requested_s": 0.0, "clamped_s": 0.0, "elapsed_s": 0.0, "timing_error_s": 0.0})
+            totals["sleeps"] += len(group)
+            totals["requested_s"] += group["requested"].sum()
+            totals["clamped_s"] += group["clamped"].sum()
+            totals["elapsed_s"] += group["elapsed"].sum()
+            # Sleeps are in simulated seconds, divided by the speed up factor
+            totals["timing_error_s"] += (group["elapsed"] - group["clamped"] / self.speedup).abs().sum()
+        return sleeps.iloc[[-1]][["time", "bot", "level", "message"]]
+
+    def bots_frame(self):
+        rows = []
+        for bot in sorted(self.counts):
+            counts = self.counts[bot]
+            rows.append({
+                "bot": bot,
+                **counts,
+                "abort_rate": counts["aborts"] / counts["llm_calls"] if counts["llm_calls"] else np.nan,
+                **self.llm_durations.summarize((bot,), "llm"),
+            })
+        return pd.DataFrame(rows)
+
+    def delays_frame(self, get_chars):
+        """
+        get_chars(bot) returns the characters read and written by the bot, by kind of delay.
+        """
+        rows = []
+        for (bot, kind), totals in sorted(self.delays.items()):
+            nominal_speed = READ_SPEED if kind == "reading" else WRITE_SPEED
+            simulated_elapsed_s = totals["elapsed_s"] * self.speedup
+            chars = (get_chars(bot) or {}).get(kind, np.nan)
+            rows.append({
+                "bot": bot,
+                "kind": kind,
+                **totals,
+                "chars": chars,
+                "nominal_chars_per_s": nominal_speed,
+                # Characters actually read or written over the time the delays took
+                "effective_chars_per_s": chars / simulated_elapsed_s if simulated_elapsed_s else np.nan,
+                "clamped_ratio": totals["clamped_s"] / totals["requested_s"] if totals["requested_s"] else np.nan,
+                "timing_error_mean_s": totals["timing_error_s"] / totals["sleeps"],
+            })
+        return pd.DataFrame(rows)
+
+def get_log_files(directory):
+    # Current logs and their rotated, gzipped backups
+    return sorted(path for path in glob.glob(os.path.join(directory, "*.log*"))
+                  if path.endswith(".log") or path.endswith(".gz"))
+
+def write_table(frame, directory, name):
+    path = os.path.join(directory, f"{name}.{TABLE_FORMAT}")
+    if TABLE_FORMAT == "parquet":
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(frame, preserve_index=False), path)
+    else:
+        frame.to_csv(path, index=False)
+    return path
+
+def read_table(directory, name):
+    path = os.path.join(directory, f"{name}.parquet")
+    if pyarrow is not None and os.path.exists(path):
+        return pyarrow.parquet.read_table(path).to_pandas()
+    path = os.path.join(directory, f"{name}.csv")
+    if os.path.exists(path):
+        return pd.read_csv(path)
+    return None
+
+# Metrics compared with --baseline, by table and key columns
+COMPARED = {
+    "messages": (["room", "name"], ["messages_per_min", "reply_latency_p50_s", "reply_latency_p90_s"]),
+    "bots": (["bot"], ["abort_rate", "llm_p50_s", "llm_p90_s"]),
+    "delays": (["bot", "kind"], ["effective_chars_per_s", "timing_error_mean_s"]),
+}
+
+def compare(tables, baseline_directory):
+    for name, (keys, columns) in COMPARED.items():
+        baseline = read_table(baseline_directory, name)
+        frame = tables[name]
+        if baseline is None or frame.empty:
+            continue
+        columns = [column for column in columns if column in frame.columns and column in baseline.columns]
+        merged = frame[keys + columns].merge(baseline[keys + columns], on=keys, how="outer", suffixes=("", "_baseline"))
+        for column in columns:
+            merged[f"{column}_change"] = merged[column] - merged[f"{column}_baseline"]
+        print(f"\n{name} (compared with {baseline_directory})")
+        print(merged.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyze the recorded conversations and bot logs of a run.")
+    parser.add_argument("--conversations", default="output/conversations", help="Directory of the room CSV files (default: output/conversations)")
+    parser.add_argument("--logs", default="output/logs", help="Directory of the bot logs (default: output/logs)")
+    parser.add_argument("--output", default="output/analysis/latest", help="Directory the tables are written to (default: output/analysis/latest)")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Speed up factor of the run, as in main.py (default: 1)")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_LINES, help=f"Lines read at once (default: {CHUNK_LINES})")
+    parser.add_argument("--baseline", help="Directory of the tables of another run to compare with")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    conversation_files = sorted(glob.glob(os.path.join(args.conversations, "*.csv")))
+    conversations = ConversationStats()
+    for path in conversation_files:
+        conversations.add_file(path, args.chunksize)
+
+    log_files = get_log_files(args.logs)
+    logs = LogStats(args.speedup)
+    for path in log_files:
+        logs.add_file(path, args.chunksize)
+    print(f"Analyzed {len(conversation_files)} conversations and {len(log_files)} log files", file=sys.stderr)
+    skipped_lines = conversations.skipped_lines + logs.skipped_lines
+    malformed_records = conversations.malformed_records + logs.malformed_records
+    if skipped_lines or malformed_records:
+        print(f"Skipped {skipped_lines} lines outside of any record and {malformed_records} malformed records", file=sys.stderr)
+
+    tables = {
+        "messages": conversations.to_frame(logs.counts.keys()),
+        "bots": logs.bots_frame(),
+        "delays": logs.delays_frame(conversations.get_chars),
+    }
+    os.makedirs(args.output, exist_ok=True)
+    for name, frame in tables.items():
+        path = write_table(frame, args.output, name)
+        print(f"\n{name} ({path})")
+        print(frame.to_string(index=False, float_format=lambda value: f"{value:.3f}") if not frame.empty else "(empty)")
+
+    if args.baseline:
+        compare(tables, args.baseline)
+
+if __name__ == "__main__":
+    main()
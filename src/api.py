@@ -1,31 +1,115 @@
-import requests
+import aiohttp
+import asyncio
+import json
+import sys
 from datetime import datetime, timezone
 
+# Decode the message payloads with orjson if it is installed (pip install orjson), it is several times faster
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 BASE_API_URL = "http://localhost:3000/api/messages"  # Replace with your actual URL when deployed
 
-def get_messages(room_id):
-    response = requests.get(f"{BASE_API_URL}?roomId={room_id}")
-    return response.json()
+# Connection pool settings, shared by every caller in the process
+CONNECTION_LIMIT = 100          # Maximum number of simultaneous connections
+CONNECTION_LIMIT_PER_HOST = 0   # Maximum number of simultaneous connections per host (0 means no limit)
+KEEPALIVE_TIMEOUT_S = 30        # Time an idle connection is kept open for reuse
+REQUEST_TIMEOUT_S = 30          # Total time allowed for a request
+CONNECT_TIMEOUT_S = 5           # Time allowed to establish a connection
+
+_session: aiohttp.ClientSession | None = None
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Return the long-lived session of the process, creating it on first use.
+    Must be called from within the running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT_S,
+        )
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S, connect=CONNECT_TIMEOUT_S)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+async def get_messages(room_id):
+    async with get_session().get(BASE_API_URL, params={"roomId": room_id}) as response:
+        if response.status == 200:
+            return await response.json()
+        else:
+            print(f"Error fetching messages: {response.status}", file=sys.stderr)
+            return []
+
+async def get_new_messages(room_id, cursor=0, generation=None, wait_s=None):
+    """
+    Fetch only the messages of the room after the given cursor (number of messages already received).
+    Returns a dict with the new `messages`, the next `cursor`, the server `generation` and whether
+    the client must `reset` its copy of the room (in which case `messages` is the full history),
+    along with the `size` in bytes of the response.
+
+    With wait_s (long-poll), the server holds the request for up to wait_s seconds until there is a
+    new message. `long_poll` tells whether the server supports it (others answer right away).
+    Raises aiohttp.ClientResponseError if the server answers with an error.
+    """
+    params = {"roomId": room_id, "since": cursor}
+    if generation is not None:
+        params["generation"] = generation
+    timeout = None
+    if wait_s is not None:
+        params["wait"] = wait_s
+        timeout = aiohttp.ClientTimeout(total=wait_s + REQUEST_TIMEOUT_S, connect=CONNECT_TIMEOUT_S)
+    async with get_session().get(BASE_API_URL, params=params, timeout=timeout) as response:
+        # An error (e.g. a transient 5xx) says nothing about long-poll support, so it is not an empty update
+        response.raise_for_status()
+        body = await response.read()
+    data = json_loads(body)
 
-def send_message(message):
+    # Servers without incremental support return the full history, so slice it here
+    if isinstance(data, list):
+        reset = cursor > len(data)
+        return {
+            "messages": data if reset else data[cursor:],
+            "cursor": len(data),
+            "generation": generation,
+            "reset": reset,
+            "size": len(body),
+            "long_poll": False,
+        }
+    data["size"] = len(body)
+    data["long_poll"] = data.pop("longPoll", False)
+    return data
+
+async def send_message(message):
     message["timestamp"] = datetime.now(timezone.utc).isoformat()
-    response = requests.post(BASE_API_URL, json=message)
-    return response.json()
+    async with get_session().post(BASE_API_URL, json=message) as response:
+        return await response.json()
 
 # Example usage
-if __name__ == "__main__":
+async def main():
     room_id = "test"  # Specify the room ID
     bot_name = "PythonBot"
     bot_email = "pythonbot@example.com"  # Add an email for the bot
 
     # Get all messages
-    messages = get_messages(room_id)
+    messages = await get_messages(room_id)
     print(f"Current messages in {room_id}:")
     for msg in messages:
         print(f"{msg['name']}: {msg['content']}")
 
     # Send a new message
-    new_message = send_message({
+    new_message = await send_message({
         "roomId": room_id,
         "name": bot_name,
         "email": bot_email,
@@ -34,7 +118,12 @@ if __name__ == "__main__":
     print(f"Sent message: {new_message}")
 
     # Get updated messages
-    updated_messages = get_messages(room_id)
+    updated_messages = await get_messages(room_id)
     print(f"\nUpdated messages in {room_id}:")
     for msg in updated_messages:
-        print(f"{msg['name']}: {msg['content']}")
\ No newline at end of file
+        print(f"{msg['name']}: {msg['content']}")
+
+    await close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""
+Benchmark of the per-poll cost of ChatHistoryInteractionManager.update_messages.
+The room is pre-filled with N messages, then each poll delivers a single new message.
+The cost per poll should stay flat regardless of N.
+
+Usage: python3 src/bench_history.py [--sizes 100,1000,10000,100000] [--polls 200]
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+import conversation_manager
+import message_record
+import utils
+
+ROOM = "bench"
+BOT_NAME = "BenchBot"
+
+def build_message(i):
+    return message_record.MessageRecord.from_json({
+        "roomId": ROOM,
+        "name": f"user{i % 7}",
+        "email": f"user{i % 7}@bench.bench",
+        "content": f"Message number {i} with a bit of text to read",
+        "timestamp": "2024-01-01T00:00:00Z",
+    })
+
+async def bench_size(size, polls):
+    logger = logging.getLogger("bench_history")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    manager = conversation_manager.ChatHistoryInteractionManager(BOT_NAME, ROOM, logger)
+
+    # Pre-fill the room, it counts as already read
+    await manager.update_messages([build_message(i) for i in range(size)], reset=True)
+    await manager.abort_sending_message()
+
+    durations = []
+    for i in range(size, size + polls):
+        # The record is built once by the room monitor, only the cost for the bot is measured
+        messages = [build_message(i)]
+        start = time.perf_counter()
+        await manager.update_messages(messages)
+        durations.append(time.perf_counter() - start)
+        await manager.abort_sending_message()
+    return durations
+
+async def run(sizes, polls):
+    # Make simulated reading as short as possible, only ingestion cost is measured
+    utils.SPEED_UP_FACTOR = 1e12
+
+    print(f"{'messages':>10} {'median (us)':>12} {'p95 (us)':>10}")
+    for size in sizes:
+        durations = await bench_size(size, polls)
+        median = statistics.median(durations) * 1e6
+        p95 = statistics.quantiles(durations, n=20)[-1] * 1e6
+        print(f"{size:>10} {median:>12.1f} {p95:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-poll cost of the conversation history.")
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="Comma-separated list of room sizes")
+    parser.add_argument("--polls", type=int, default=200, help="Number of polls measured per room size")
+    args = parser.parse_args()
+
+    asyncio.run(run([int(size) for size in args.sizes.split(",")], args.polls))
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
+import clock
 import llm_client
+import context_window
 import conversation_manager
 import api
+import metrics
+import tracing
+import prompt_cache
 import utils
 import os
 import re
@@ -10,6 +15,30 @@ import asyncio
 import time
 
 SEND_INITIAL_MESSAGE = False
+SPECULATIVE = False     # --speculative, generate the reply while the bot is still reading the messages
+
+# Responses starting with any of these were censored by the LLM
+FORBIDDEN_STARTS: list[str] = [
+    "I'm sorry,",
+    "I'm very sorry,",
+    "I'm really sorry,",
+    "I can't",
+    "I'm unable to",
+]
+
+def is_forbidden(response):
+    return any(response.startswith(forb) for forb in FORBIDDEN_STARTS)
+
+def may_become_forbidden(response_start):
+    return any(forb.startswith(response_start) for forb in FORBIDDEN_STARTS)
+
+def read_prompt_files(description_path, *names):
+    return [utils.read_file_text(f'{description_path}/{name}') for name in names]
+
+def write_prompt_file(output_dir, filename, text):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, filename), 'w') as file:
+        file.write(text)
 
 class ChatBot():
     def __init__(self, description):
@@ -18,124 +47,263 @@ class ChatBot():
 
         self.description = description
         self.logger = utils.get_logger(f'{description["chatroom"]}_{description["role"]}_{description["username"]}')
+        self.speculative = SPECULATIVE
+        self.speculation = None     # (read index, task) of the reply being generated while reading
+
+    async def start_bot(self, checkpoint=None):
+        """
+        checkpoint is the conversation state to resume from, see ChatHistoryInteractionManager.get_checkpoint.
+        """
+        self.logger.info('Starting ChatBot %s', self.description["username"])
+        await self.on_ready(checkpoint)
 
-    async def start_bot(self):
-        self.logger.info(f'Starting ChatBot {self.description["username"]}')
-        await self.on_ready()
+    async def stop_bot(self):
+        """
+        Stop the background work of the bot, once it is unsubscribed from its room.
+        """
+        self.cancel_speculation()
+        if self.messages.window is not None:
+            self.messages.window.reset()
 
-    async def send_message(self, message, recorder=None, greeting=False):
+    async def send_message(self, message, recorder=None, greeting=False, typing_started_at=None):
         # Simulate writing message
         if recorder is not None:
-            await recorder.write_message(message, greeting)
+            await recorder.write_message(message, greeting, typing_started_at)
 
-        self.logger.debug(f'Sending message {message[:100]}')
-        response = api.send_message({
+        self.logger.debug('Sending message %s', message[:100])
+        response = await api.send_message({
             "roomId": self.description["chatroom"],
             "name": self.description["username"],
             "email": self.description["email"],
             "content": message,
         })
-        self.logger.debug(f"RESPONSE: {response}")
+        self.logger.debug('RESPONSE: %s', response)
+
+        labels = {"bot": self.description["username"], "room": self.description["chatroom"]}
+        metrics.REPLIES.inc(**labels)
+        if recorder is not None and not greeting and recorder.reading_started_at is not None:
+            metrics.REPLY_LATENCY.observe(clock.now() - recorder.reading_started_at, **labels)
 
-    async def update_messages(self, messages):
+    async def update_messages(self, messages, reset=False):
         try:
             # Update message list, get whether we need to write a message afterwards
-            write_afterwards = await self.messages.update_messages(messages)
+            write_afterwards = await self.messages.update_messages(messages, reset)
 
             # No message to write
             if not write_afterwards: return
 
-            # Get the next message via GPT
-            time_before_llm_call = time.time()
-            response = self.llm_client.continue_conversation(await self.messages.get_relevant_history(self.system_prompt))
-            self.logger.info(f'LLM call lasted {time.time() - time_before_llm_call:.3f}s')
+            # Get the next message via GPT, unless it was generated while reading
+            speculation = self.take_speculation()
+            if speculation is not None:
+                response, typing_started_at = await speculation
+                # The bot cannot start typing before it finished reading
+                if typing_started_at is not None:
+                    typing_started_at = max(typing_started_at, clock.now())
+            else:
+                history = await self.messages.get_relevant_history(self.system_prompt)
+                response, typing_started_at = await self.generate_response(history)
 
             # Abort response if it is empty (in principle None, but also acccepting empty strings)
             if not response:
-                self.logger.error(f"Response was empty or None {response}. Aborting.")
+                self.logger.error("Response was empty or None %s. Aborting.", response)
+                self.count_abort("empty")
                 await self.messages.abort_sending_message()
                 return
 
             # Abort if response was censored by the LLM
-            FORBIDDEN_STARTS: list[str] = [
-                "I'm sorry,",
-                "I'm very sorry,",
-                "I'm really sorry,",
-                "I can't",
-                "I'm unable to",
-            ]
-            if any(response.startswith(forb) for forb in FORBIDDEN_STARTS):
-                self.logger.error("Response {response} starts with forbidden string. Aborting.")
+            if is_forbidden(response):
+                self.logger.error("Response %s starts with forbidden string. Aborting.", response)
+                self.count_abort("forbidden")
                 await self.messages.abort_sending_message()
                 return
             
             # Clean the response
             response = utils.clean_text_start(response)
             
-            await self.send_message(response, recorder=self.messages)
+            await self.send_message(response, recorder=self.messages, typing_started_at=typing_started_at)
         except Exception as err:
-            self.logger.error(f"Unexpected {err=}, {type(err)=} for on_message")
+            self.logger.error("Unexpected err=%r, type(err)=%r for on_message", err, type(err))
+            self.count_abort("error")
+        finally:
+            self.cancel_speculation()
+
+    async def generate_response(self, history):
+        """
+        Returns the next message for the history, and the time the bot started typing it if streamed.
+        """
+        deadline = await self.messages.get_deadline()
+        time_before_llm_call = time.time()
+        typing_started_at = None
+        with tracing.span("llm", self.messages.trace, messages=len(history), stream=llm_client.STREAM):
+            if llm_client.STREAM:
+                response, typing_started_at = await self.stream_response(history, deadline)
+            else:
+                response = await self.llm_client.continue_conversation(history, deadline)
+        self.logger.info('LLM call lasted %.3fs', time.time() - time_before_llm_call)
+        return response, typing_started_at
+
+    def speculate(self, read_index):
+        """
+        Start generating the reply as soon as the bot starts reading, so the LLM latency overlaps
+        the reading delay. The generation is restarted whenever the bot reads more messages.
+        Called by the ChatHistoryInteractionManager with the history lock held.
+        """
+        if self.speculation is not None:
+            self.count_speculation("discarded")
+            self.cancel_speculation()
+        history = self.messages.build_relevant_history(self.system_prompt)
+        self.speculation = (read_index, asyncio.create_task(self.generate_response(history)))
+
+    def take_speculation(self):
+        """
+        Returns the task generating the reply to the messages read, if any.
+        """
+        if self.speculation is None:
+            return None
+        read_index, task = self.speculation
+        self.speculation = None
+        if read_index != self.messages.last_read_index:
+            self.count_speculation("discarded")
+            task.cancel()
+            return None
+        self.count_speculation("used")
+        return task
+
+    def cancel_speculation(self):
+        if self.speculation is None:
+            return
+        _, task = self.speculation
+        self.speculation = None
+        task.cancel()
+        # Retrieve the exception of a failed generation, it is not used
+        if task.done() and not task.cancelled():
+            task.exception()
+
+    def count_speculation(self, outcome):
+        metrics.SPECULATIONS.inc(bot=self.description["username"], room=self.description["chatroom"], outcome=outcome)
+
+    def count_abort(self, reason):
+        metrics.ABORTS.inc(bot=self.description["username"], room=self.description["chatroom"], reason=reason)
+
+    async def stream_response(self, history, deadline=None):
+        """
+        Stream the next message, returning it along with the time its first token arrived,
+        which is when the bot starts "typing". Generation stops as soon as the start of the
+        message shows it was censored by the LLM, and only that start is returned.
+        """
+        chunks = []
+        first_token_time = None
+        censorship_checked = False
+        stream = self.llm_client.stream_conversation(history, deadline)
+        try:
+            async for chunk in stream:
+                if first_token_time is None:
+                    first_token_time = clock.now()
+                chunks.append(chunk)
+
+                # Check the first tokens, until they show whether the message is censored
+                if not censorship_checked:
+                    response_start = ''.join(chunks).lstrip()
+                    if is_forbidden(response_start):
+                        self.logger.info('Censored response detected while streaming, stopping generation')
+                        return response_start, first_token_time
+                    censorship_checked = not may_become_forbidden(response_start)
+        except Exception as err:
+            self.logger.error("Unexpected err=%r, type(err)=%r when streaming LLM completion", err, type(err))
+            return None, first_token_time
+        finally:
+            await stream.aclose()
+
+        return ''.join(chunks).strip(), first_token_time
 
 class LLMBot(ChatBot):
     def __init__(self, description):
         super().__init__(description)
 
         description["path"] = "assets/bot-descriptions/" + description["bot-description"]
-        self.llm_client = llm_client.LLMClient({"model" : llm_client.MODEL_NAME}, self.logger)
+        self.llm_client = llm_client.LLMClient({"model" : llm_client.MODEL_NAME}, self.logger, description["username"])
         self.typing_lock = asyncio.Lock()
+        self.system_prompt = None
 
+    async def stop_bot(self):
+        await super().stop_bot()
+        await self.llm_client.close()
+
+    async def build_system_prompt(self):
+        # File I/O runs in threads, to keep the event loop free for the other bots while this one starts
+        description = self.description
         if description["role"] == "simple":
-            self.system_prompt = utils.join_paragraphs(*map(utils.read_file_text, [
-                description["path"] + '/behavior-prompt.txt',
-                description["path"] + '/simple-prompt.txt'
-            ]))
+            self.system_prompt = utils.join_paragraphs(*await asyncio.to_thread(
+                read_prompt_files, description["path"], 'behavior-prompt.txt', 'simple-prompt.txt'))
             output_dir = "output/simple_prompts"
         else:
-            self.system_prompt = self.generate_elaborated_prompt(description["path"])
-            self.logger.debug(f'Elaborated system prompt:\n {self.system_prompt}')
+            self.system_prompt = await self.generate_elaborated_prompt(description["path"])
+            self.logger.debug('Elaborated system prompt:\n %s', self.system_prompt)
             output_dir = "output/elaborated_prompts"
 
-        # Ensure the output directory exists
-        os.makedirs(output_dir, exist_ok=True)
-
         # Generate the timestamp string
         timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
 
-        # Construct the full file path
-        filename = f"{timestamp}.txt" if description["role"] == "simple" else f"{timestamp}-{llm_client.MODEL_NAME}.txt"
-        file_path = os.path.join(output_dir, filename)
-
         # Write the system prompt to the file
-        with open(file_path, 'w') as file:
-            file.write(self.system_prompt)
+        filename = f"{timestamp}.txt" if description["role"] == "simple" else f"{timestamp}-{llm_client.MODEL_NAME}.txt"
+        await asyncio.to_thread(write_prompt_file, output_dir, filename, self.system_prompt)
 
-    async def on_ready(self):
+    async def on_ready(self, checkpoint=None):
         self.logger.debug("on_ready")
 
+        # Build the system prompt (may require an LLM call for elaborated bots)
+        await self.build_system_prompt()
+
         # Build message recorder
         self.messages = conversation_manager.ChatHistoryInteractionManager(
-            self.description["username"], self.description["chatroom"], self.logger)
+            self.description["username"], self.description["chatroom"], self.logger,
+            context_window.ContextWindow(llm_client.MODEL_NAME, self.llm_client, self.logger))
+        if checkpoint is not None:
+            self.messages.restore(checkpoint)
+        if self.speculative:
+            self.messages.on_read = self.speculate
 
-        greeting = self.llm_client.complete_from_message("Hi!", self.system_prompt)
-        self.logger.info(f'Bot is connected and ready as {self.description["username"]}. "{greeting}"')
+        greeting = await self.complete_from_message_cached("Hi!", [self.system_prompt], self.system_prompt)
+        self.logger.info('Bot is connected and ready as %s. "%s"', self.description["username"], greeting)
         
-        if SEND_INITIAL_MESSAGE:
+        # Resumed bots already greeted the room
+        if SEND_INITIAL_MESSAGE and checkpoint is None:
             await self.send_message("hello everyone!", recorder=self.messages, greeting=True)
 
-    def generate_elaborated_prompt(self, description_path):
-        # Read behavior prompt
-        behavior_prompt_text = utils.read_file_text(description_path + '/behavior-prompt.txt')
+    async def complete_from_message_cached(self, message, prompt_texts, system_prompt=None, find_previous_response=None):
+        """
+        Same as LLMClient.complete_from_message, but reusing the response of previous runs
+        with the same model, prompt files and messages.
+        On a cache miss, find_previous_response (if given) may recover it from other outputs.
+        """
+        key = prompt_cache.get_key(llm_client.MODEL_NAME, prompt_texts, [message, system_prompt])
+        response = await asyncio.to_thread(prompt_cache.get, key)
+        if response is None and find_previous_response is not None:
+            response = await asyncio.to_thread(find_previous_response)
+            await asyncio.to_thread(prompt_cache.put, key, response)
+        if response is not None:
+            self.logger.info('Using cached completion for message ending in %s', message[-100:])
+            return response
 
-        # Read elaborated prompt
-        elaborated_prompt_text = utils.read_file_text(description_path + '/elaborated-prompt.txt')
+        response = await self.llm_client.complete_from_message(message, system_prompt)
+        await asyncio.to_thread(prompt_cache.put, key, response)
+        return response
 
-        # Get self-reflected response
-        self_reflection_response = self.llm_client.complete_from_message(elaborated_prompt_text)
-        if self_reflection_response is None:
-            self.logger.error(f"self_reflection_response not set")
+    async def generate_elaborated_prompt(self, description_path):
+        # Read the behavior prompt, the elaborated prompt and its completion
+        behavior_prompt_text, elaborated_prompt_text, elaborated_prompt_completion_text = await asyncio.to_thread(
+            read_prompt_files, description_path, 'behavior-prompt.txt', 'elaborated-prompt.txt', 'elaborated-prompt-completion.txt')
 
-        # Complete the elaborated prompt
-        elaborated_prompt_completion_text = utils.read_file_text(description_path + '/elaborated-prompt-completion.txt')
+        # Get self-reflected response, reusing the one of a previous elaborated prompt if the prompt files did not change
+        self_reflection_response = await self.complete_from_message_cached(
+            elaborated_prompt_text,
+            [behavior_prompt_text, elaborated_prompt_text, elaborated_prompt_completion_text],
+            find_previous_response=lambda: prompt_cache.find_elaborated_prompt(
+                llm_client.MODEL_NAME,
+                utils.join_paragraphs(behavior_prompt_text, elaborated_prompt_text, ''),
+                utils.join_paragraphs('', elaborated_prompt_completion_text)))
+        if self_reflection_response is None:
+            self.logger.error("self_reflection_response not set")
 
         # Merge all paragraphs
         return utils.join_paragraphs(
@@ -0,0 +1,55 @@
+"""
+Checkpoints of the conversation state of the bots (read cursor, character totals, messages sent but
+not received yet and ChatState), written atomically every CHECKPOINT_INTERVAL_S while main.py runs.
+With --resume, restarted bots restore them and only read the messages received since, instead of
+re-reading the whole room history and replying to stale context.
+"""
+import asyncio
+import glob
+import json
+import os
+import time
+
+import utils
+
+CHECKPOINT_INTERVAL_S = 15
+CHECKPOINT_DIRECTORY = 'output/checkpoints'
+
+def get_checkpoint_file(experiment):
+    return f'{CHECKPOINT_DIRECTORY}/{experiment}.json'
+
+def read_checkpoints(filename):
+    """
+    Checkpoints of the bots by name, including the ones written by the shards of a sharded run
+    (so a run can be resumed with a different number of shards).
+    """
+    root, extension = os.path.splitext(filename)
+    checkpoints = {}
+    for path in [filename] + sorted(glob.glob(f'{glob.escape(root)}.shard*{extension}')):
+        try:
+            with open(path) as file:
+                checkpoints.update(json.load(file)["bots"])
+        except (OSError, ValueError, KeyError):
+            continue
+    return checkpoints
+
+def get_checkpoints(bots, previous_checkpoints=None):
+    """
+    bots maps the name of every running bot to the bot.
+    The previous checkpoints of the bots not running yet (still starting) are kept.
+    """
+    checkpoints = dict(previous_checkpoints or {})
+    checkpoints.update((name, bot.messages.get_checkpoint()) for name, bot in bots.items())
+    return {"time": time.time(), "bots": checkpoints}
+
+async def write_checkpoints_periodically(filename, bots, interval_s=CHECKPOINT_INTERVAL_S, previous_checkpoints=None):
+    """
+    Write the checkpoints every interval_s seconds, and a last one when cancelled.
+    """
+    try:
+        while True:
+            await asyncio.sleep(interval_s)
+            # Taken at once on the event loop, so every bot is in a consistent state
+            await asyncio.to_thread(utils.write_json_atomic, filename, get_checkpoints(bots, previous_checkpoints))
+    finally:
+        utils.write_json_atomic(filename, get_checkpoints(bots, previous_checkpoints))
@@ -0,0 +1,86 @@
+"""
+Clock of the bots. By default it is the wall clock, but simulations can run on a virtual-time event
+loop, where sleeping advances the clock instantly instead of waiting. This makes timing behaviour
+deterministic and lets simulated conversations run far faster than real time.
+
+The virtual-time loop is only meant for simulations without real I/O: whenever every task is
+sleeping, time jumps to the next timer, even if a network request or thread is still running.
+"""
+import asyncio
+import selectors
+import time
+
+class RealClock:
+    def now(self):
+        return time.time()
+
+class VirtualClock:
+    def __init__(self, loop, start_time=None):
+        self.loop = loop
+        self.start_time = time.time() if start_time is None else start_time
+
+    def now(self):
+        return self.start_time + self.loop.time()
+
+CLOCK = RealClock()
+
+def now():
+    """
+    Current time in seconds since the epoch, use it instead of time.time() for anything simulated.
+    """
+    return CLOCK.now()
+
+class _VirtualTimeSelector:
+    """
+    Selector that advances the virtual time of the loop instead of blocking until the next timer.
+    """
+    def __init__(self, selector):
+        self.selector = selector
+        self.loop = None
+
+    def select(self, timeout=None):
+        events = self.selector.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # No timers at all, only I/O (e.g. a thread finishing) can wake the loop
+            return self.selector.select(None)
+        self.loop.virtual_time += timeout
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        selector = _VirtualTimeSelector(selectors.DefaultSelector())
+        super().__init__(selector)
+        selector.loop = self
+        self.virtual_time = 0.0
+
+    def time(self):
+        return self.virtual_time
+
+def run_virtual(main, start_time=None):
+    """
+    Run the coroutine on a virtual-time event loop, with CLOCK following its virtual time.
+    Works like asyncio.run.
+    """
+    global CLOCK
+    loop = VirtualTimeEventLoop()
+    previous_clock = CLOCK
+    CLOCK = VirtualClock(loop, start_time)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            CLOCK = previous_clock
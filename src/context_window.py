@@ -0,0 +1,122 @@
+"""
+Token-budgeted context sent to the LLM: the system prompt, an optional rolling summary of the
+older messages and as many of the most recent messages as fit in the budget of the model.
+This keeps the prompt size (and so cost and time to first token) bounded however long the
+conversation gets.
+"""
+import asyncio
+
+import utils
+
+CONTEXT_TOKEN_BUDGET = 4000         # --context_tokens, maximum tokens of context sent per call
+RESPONSE_TOKENS_RESERVED = 1024     # Tokens of the model context left for the response
+SUMMARIZE = False                   # --summarize, keep a rolling summary of the messages out of the window
+SUMMARY_REFRESH_MESSAGES = 20       # Refresh the summary once this many messages left the window
+
+# Context size of the models, matched by substring like llm_client.get_client
+MODEL_CONTEXT_TOKENS = {
+    "8192": 8192,
+    "32768": 32768,
+    "gemma": 8192,
+    "gpt-3.5": 16385,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+}
+
+# Tokens are estimated, there is no tokenizer shared by all providers
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+
+SUMMARY_PROMPT = ("Summarize the following chat conversation in a few sentences, keeping who said what "
+                  "and the main arguments. Only output the summary.")
+
+def count_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + TOKENS_PER_MESSAGE
+
+def get_token_budget(model: str) -> int:
+    for substr, context_tokens in MODEL_CONTEXT_TOKENS.items():
+        if substr in model:
+            return min(CONTEXT_TOKEN_BUDGET, context_tokens - RESPONSE_TOKENS_RESERVED)
+    return CONTEXT_TOKEN_BUDGET
+
+class ContextWindow:
+    def __init__(self, model, llm_client, logger):
+        self.budget = get_token_budget(model)
+        self.llm_client = llm_client
+        self.logger = logger
+
+        # Rolling summary of history[:summary_end]
+        self.summary = None
+        self.summary_tokens = 0
+        self.summary_end = 0
+        self.summary_task = None
+
+    def reset(self):
+        if self.summary_task is not None:
+            self.summary_task.cancel()
+        self.summary = None
+        self.summary_tokens = 0
+        self.summary_end = 0
+        self.summary_task = None
+
+    def build(self, system_prompt, history, history_tokens, end):
+        """
+        Build the messages for the LLM from history[:end], given the cached token count of each entry.
+        Costs work proportional to the messages in the window only.
+        """
+        system_message = utils.build_message('system', system_prompt)
+        budget = self.budget - count_tokens(system_prompt)
+        if self.summary is not None:
+            budget -= self.summary_tokens
+
+        # Walk back from the most recent message while it fits
+        start = end
+        while start > 0 and history_tokens[start - 1] <= budget:
+            start -= 1
+            budget -= history_tokens[start]
+        if start > 0:
+            self.logger.debug('Context window keeps %d of %d messages', end - start, end)
+
+        if SUMMARIZE:
+            self.refresh_summary(history, history_tokens, start)
+
+        messages = [system_message]
+        if start > 0 and self.summary is not None:
+            messages.append(utils.build_message('system', f'Summary of the earlier conversation: {self.summary}'))
+        return messages + history[start:end]
+
+    def refresh_summary(self, history, history_tokens, window_start):
+        """
+        Summarize in the background the messages that left the window since the last summary.
+        """
+        if self.summary_task is not None and not self.summary_task.done():
+            return
+        if window_start - self.summary_end < SUMMARY_REFRESH_MESSAGES:
+            return
+
+        # Take as many of those messages as fit in the budget, the rest is left for the next refresh
+        end = self.summary_end
+        budget = self.budget - count_tokens(SUMMARY_PROMPT) - self.summary_tokens
+        while end < window_start and history_tokens[end] <= budget:
+            budget -= history_tokens[end]
+            end += 1
+        if end == self.summary_end:
+            return
+
+        transcript = '\n'.join(msg['content'] for msg in history[self.summary_end:end])
+        self.summary_task = asyncio.create_task(self.summarize(transcript, end))
+
+    async def summarize(self, transcript, end):
+        parts = [SUMMARY_PROMPT]
+        if self.summary is not None:
+            parts.append(f'Summary of the conversation so far: {self.summary}')
+        parts.append(transcript)
+        try:
+            summary = await self.llm_client.complete_from_message(utils.join_paragraphs(*parts))
+        except Exception as err:
+            self.logger.error("Unexpected err=%r, type(err)=%r when summarizing the conversation", err, type(err))
+            return
+        self.summary = summary
+        self.summary_tokens = count_tokens(summary)
+        self.summary_end = end
+        self.logger.info('Conversation summary now covers %d messages', end)
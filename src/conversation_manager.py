@@ -1,7 +1,10 @@
 import asyncio
 from enum import Enum
-import time
 from typing import List, Dict
+import clock
+import context_window
+import metrics
+import tracing
 import utils
 
 class ChatState(Enum):
@@ -11,84 +14,148 @@ class ChatState(Enum):
     AWAITING_RECEIVE = 3
 
 class ChatHistoryInteractionManager:
-    def __init__(self, name: str, chatroom: str, logger):
+    def __init__(self, name: str, chatroom: str, logger, window: context_window.ContextWindow = None):
         # Initialize the chat state machine with user info and settings
         self.name = name
         self.chatroom = chatroom
         self.logger = logger
+        self.window = window    # If None, the whole history read so far is sent to the LLM
 
         # Initialize state and history
         self.state = ChatState.IDLE
         self.last_state_change_comes_from_abort = False
-        self.last_idle_state = time.time()
+        self.last_idle_state = clock.now()
+        self.state_changed_at = clock.now()
+        self.reading_started_at = None  # When the bot started reading the messages it is replying to
+        self.trace = None               # Trace of the current reply, if sampled
         self.history: List[Dict] = []
+        self.history_tokens: List[int] = []     # Estimated tokens of each history entry
         self.unreceived_sent_messages: set[str] = set()
+        self.resume_checkpoint = None   # Checkpoint to apply once the room history is received
+        self.on_read = None     # Called with the read index (history lock held) whenever the bot reads more messages
 
         # Initialize locks for thread-safe operations
         self.history_lock = asyncio.Lock()
         self.state_lock = asyncio.Lock()
 
         # Initialize counters
-        self.total_chars = 0
-        self.last_read_index = 0
+        self.total_chars = 0        # Characters already read
+        self.last_read_index = 0    # History entries already read
+        self.received_chars = 0     # Running total of characters received from other authors
+        self.reply_start_cursor = (0, 0)    # last_read_index and total_chars before the current reply
 
     async def sleep(self, time_s, reason):
         clamped_time_s = min(time_s, await self.get_max_duration())
-        self.logger.info(f'Going to sleep for {clamped_time_s}s (clamped from {time_s}s) due to {reason}')
-        await utils.bot_sleep(clamped_time_s, self.logger)
-        self.logger.info(f'Completed sleeping for {clamped_time_s}s due to {reason}')
+        self.logger.info('Going to sleep for %ss (clamped from %ss) due to %s', clamped_time_s, time_s, reason)
+        with tracing.span(reason, self.trace, time_s=time_s, clamped_time_s=clamped_time_s):
+            await utils.bot_sleep(clamped_time_s, self.logger)
+        self.logger.info('Completed sleeping for %ss due to %s', clamped_time_s, reason)
 
     async def get_max_duration(self):
         async with self.state_lock:
-            return max(0, min(time.time() - self.last_idle_state, utils.MAX_RESPONSE_DURATION_S))
+            return max(0, min(clock.now() - self.last_idle_state, utils.MAX_RESPONSE_DURATION_S))
+
+    async def get_deadline(self):
+        """
+        Time by which the bot should have answered, given MAX_RESPONSE_DURATION_S.
+        """
+        async with self.state_lock:
+            return self.last_idle_state + utils.MAX_RESPONSE_DURATION_S
 
     # Assumes lock is already in place
     def check_state_is_expected(self, expected_state):
         if self.state != expected_state:
-            self.logger.error(f'Unexpected state {self.state}, expected {expected_state}')
+            self.logger.error('Unexpected state %s, expected %s', self.state, expected_state)
 
     # Assumes lock is already in place
     def check_update_last_idle(self):
         if self.state == ChatState.IDLE and not self.last_state_change_comes_from_abort:
-            self.last_idle_state = time.time()
+            self.last_idle_state = clock.now()
 
     # Assumes lock is already in place
     def update_state(self, new_state, aborted=False):
         self.check_update_last_idle()
-        print(f'Updating state from {self.state} to {new_state}')
-        self.logger.debug(f'Updating state from {self.state} to {new_state}')
+        self.logger.debug('Updating state from %s to %s', self.state, new_state)
+        now = clock.now()
+        metrics.STATE_DURATION.inc(now - self.state_changed_at, bot=self.name, room=self.chatroom, state=self.state.name)
+        self.state_changed_at = now
+        if new_state == ChatState.READING:
+            self.reading_started_at = now
+            # The spans of the reply (including the LLM calls made from this task) go to its trace
+            self.trace = tracing.start_trace("reply", self.name, now, room=self.chatroom)
+            tracing.set_current(self.trace)
+        elif new_state == ChatState.IDLE and self.trace is not None:
+            self.trace.finish(now, aborted=aborted)
+            self.trace = None
         self.state = new_state
         self.last_state_change_comes_from_abort = aborted
         self.check_update_last_idle()
 
-    async def update_messages(self, messages) -> None:
+    async def update_messages(self, messages, reset=False) -> None:
         """
         Update the conversation history with new messages.
-        This method is called by an external library with the complete JSON of the conversation history.
+        This method is called by the room monitor with the messages received since its previous call.
+        If reset is set, messages is the complete conversation history instead.
+        Messages are MessageRecords, shared with the other bots of the room.
         """
         try:
             async with self.history_lock:
-                # Update unreceived_sent_messages
-                for msg in messages:
-                    if msg['name'] == self.name and msg['roomId'] == self.chatroom:
-                        self.unreceived_sent_messages.discard(msg['content'])
+                if reset:
+                    self.history = []
+                    self.history_tokens = []
+                    self.received_chars = 0
+
+                self._ingest_messages(messages)
+
+                if reset:
+                    # The room may have shrunk, never read past its end
+                    self.last_read_index = min(self.last_read_index, len(self.history))
+                    self.total_chars = min(self.total_chars, self.received_chars)
+                    if self.window is not None:
+                        self.window.reset()
+
+                if self.resume_checkpoint is not None and self.history:
+                    self._apply_checkpoint()
 
                 async with self.state_lock:
                     if len(self.unreceived_sent_messages) == 0 and self.state == ChatState.AWAITING_RECEIVE:
                         self.update_state(ChatState.IDLE)
 
-                # Update the history
-                self.history = [
-                    utils.build_message(
-                        'assistant' if msg['name'] == self.name else 'user',
-                        f"Message from {msg['name']}: {msg['content']}",
-                        msg['name'])
-                    for msg in messages if msg['roomId'] == self.chatroom]
-
             # Trigger the reading process if there are new messages
             return await self._process_new_messages()
         except Exception as err:
-            self.logger.error(f"Unexpected {err=}, {type(err)=} for update_messages()")
+            self.logger.error("Unexpected err=%r, type(err)=%r for update_messages()", err, type(err))
+
+    # Assumes history lock is already in place
+    def _ingest_messages(self, messages):
+        """
+        Append new messages to the history, updating the running total of characters received.
+        Costs work proportional to the number of new messages only.
+        """
+        for msg in messages:
+            if msg.room_id != self.chatroom:
+                continue
+
+            name = msg.name
+            if name == self.name:
+                self.unreceived_sent_messages.discard(msg.content)
+
+            # The entry, its prompt and tokens are computed once per message for all bots
+            self.history.append(msg.get_entry(name == self.name))
+            self.history_tokens.append(msg.tokens)
+
+            if name != self.name:
+                self.received_chars += len(msg.prompt)
+
+    def ingest_while_reading(self, messages):
+        """
+        Ingest messages received while the bot is reading, so they are read as part of the same reply.
+        Returns False, ingesting nothing, if the bot is not reading.
+        """
+        if self.state != ChatState.READING or self.history_lock.locked():
+            return False
+        self._ingest_messages(messages)
+        return True
 
     async def _process_new_messages(self) -> bool:
         """
@@ -103,17 +170,18 @@ class ChatHistoryInteractionManager:
         while True:
             async with self.history_lock:
                 # Calculate new characters to read
-                new_total_chars = sum(len(msg['content']) for msg in self.history if msg['name'] != self.name)
+                new_total_chars = self.received_chars
                 chars_to_read = new_total_chars - self.total_chars
 
                 if chars_to_read < 0:
-                    self.logger.error(f'Negative chars to read: new is {new_total_chars}, old is {self.total_chars}')
+                    self.logger.error('Negative chars to read: new is %d, old is %d', new_total_chars, self.total_chars)
                     break
                 if chars_to_read == 0:
                     break  # No new content to read
                 else:
                     # Set state to READING if nothing has been previously read
                     if total_read_chars == 0:
+                        self.reply_start_cursor = (self.last_read_index, self.total_chars)
                         async with self.state_lock:
                             self.update_state(ChatState.READING)
 
@@ -122,6 +190,8 @@ class ChatHistoryInteractionManager:
                 self.total_chars = new_total_chars
                 self.last_read_index = len(self.history)
                 total_read_chars += chars_to_read
+                if self.on_read is not None:
+                    self.on_read(self.last_read_index)
 
             # Release the lock while "reading"
             await self.sleep(read_time, "Simulating reading")
@@ -134,9 +204,10 @@ class ChatHistoryInteractionManager:
                 self.update_state(ChatState.AWAITING_WRITE)
                 return True
 
-    async def write_message(self, msg: str, greeting) -> None:
+    async def write_message(self, msg: str, greeting, typing_started_at=None) -> None:
         """
         Simulate writing a message and add it to unreceived sent messages.
+        If typing_started_at is given (streamed messages), the time since then counts as already written.
         """
         async with self.state_lock:
             if not greeting and self.state != ChatState.AWAITING_WRITE:
@@ -146,10 +217,14 @@ class ChatHistoryInteractionManager:
 
         # Simulate writing time
         write_time = len(msg) / utils.READ_SPEED
+        if typing_started_at is not None:
+            write_time = max(0, write_time - (clock.now() - typing_started_at) * utils.SPEED_UP_FACTOR)
         await self.sleep(write_time, "Simulating writing")
 
         async with self.history_lock:
             self.unreceived_sent_messages.add(msg)
+            if self.trace is not None:
+                self.trace.begin("awaiting echo")
 
     async def abort_sending_message(self):
         async with self.history_lock:
@@ -158,8 +233,50 @@ class ChatHistoryInteractionManager:
                     self.check_state_is_expected(ChatState.AWAITING_WRITE)
                 self.update_state(ChatState.IDLE, aborted=True)
 
+    def get_checkpoint(self):
+        """
+        State needed to resume the bot after a restart, as JSON.
+        A reply in progress is not resumed: the bot reads its messages again instead.
+        """
+        state, (last_read_index, total_chars) = self.state, (self.last_read_index, self.total_chars)
+        if state in (ChatState.READING, ChatState.AWAITING_WRITE):
+            state, (last_read_index, total_chars) = ChatState.IDLE, self.reply_start_cursor
+        return {
+            "state": state.name,
+            "last_read_index": last_read_index,
+            "total_chars": total_chars,
+            "unreceived_sent_messages": sorted(self.unreceived_sent_messages),
+        }
+
+    def restore(self, checkpoint):
+        """
+        Resume from get_checkpoint. The read cursor is applied once the room history is received.
+        """
+        self.state = ChatState[checkpoint["state"]]
+        self.unreceived_sent_messages = set(checkpoint["unreceived_sent_messages"])
+        self.resume_checkpoint = checkpoint
+
+    # Assumes history lock is already in place
+    def _apply_checkpoint(self):
+        checkpoint, self.resume_checkpoint = self.resume_checkpoint, None
+        # The room may have been reset since the checkpoint, never read past its end
+        self.last_read_index = min(checkpoint["last_read_index"], len(self.history))
+        self.total_chars = min(checkpoint["total_chars"], self.received_chars)
+        self.reply_start_cursor = (self.last_read_index, self.total_chars)
+        # Sent messages in the history were discarded when ingesting it, the others were never sent
+        if self.unreceived_sent_messages:
+            self.logger.warning('Dropping %d sent messages lost before the restart', len(self.unreceived_sent_messages))
+            self.unreceived_sent_messages.clear()
+        self.logger.info('Resumed after reading %d of %d messages', self.last_read_index, len(self.history))
+
     async def get_relevant_history(self, system_prompt):
         self.logger.debug("get_relevant_history")
         async with self.history_lock:
-            return [utils.build_message('system', system_prompt)] + \
-                self.history[:self.last_read_index]
+            return self.build_relevant_history(system_prompt)
+
+    # Assumes history lock is already in place
+    def build_relevant_history(self, system_prompt):
+        if self.window is not None:
+            return self.window.build(system_prompt, self.history, self.history_tokens, self.last_read_index)
+        return [utils.build_message('system', system_prompt)] + \
+            self.history[:self.last_read_index]
@@ -1,45 +1,158 @@
+import asyncio
 import random
-import time
+import signal
+import sys
 import api
 import argparse
-from itertools import cycle
+import utils
 
-# Read the file and store all lines in a list
-# Ignore empty lines and lines starting with '#'
-with open('assets/hate_speech.txt', 'r') as file:
-    attacks = list(filter(lambda phrase:
-                          phrase and not phrase.startswith('#'),
-                     map(lambda phrase:
-                         phrase.strip(), file.readlines())))
+ATTACKS_FILE = 'assets/hate_speech.txt'
+ARRIVALS = ["fixed", "poisson", "bursty"]
+BURST_SIZE = 3      # Messages in every burst of the bursty arrivals
+BURST_GAP_S = 2.0   # Seconds between the messages of a burst
+REPORT_INTERVAL_S = 60
 
-# Shuffle the list of attacks for a random permutation
-random.shuffle(attacks)
+def load_attacks(filepath=ATTACKS_FILE):
+    # Read the file and store all lines in a list
+    # Ignore empty lines and lines starting with '#'
+    with open(filepath, 'r') as file:
+        return list(filter(lambda phrase:
+                           phrase and not phrase.startswith('#'),
+                      map(lambda phrase:
+                          phrase.strip(), file.readlines())))
 
-# Create a cycle iterator to go through attacks indefinitely
-attack_cycle = cycle(attacks)
+class HaterbotGenerator:
+    """
+    Sends attacks to every room at a target rate of one message every interval_s seconds per room.
+    Each room follows its own schedule of absolute deadlines and every POST runs in its own task,
+    so neither the POST latency nor the number of rooms changes the rate.
 
-FREQ = None     # Frequency of sending messages (in seconds)
-NAMES = None    # Display names used the haterbots
+    Arrivals:
+    - fixed: exactly interval_s between messages
+    - poisson: exponential gaps with mean interval_s
+    - bursty: bursts of burst_size messages burst_gap_s apart, with exponential gaps between bursts
+      keeping the mean rate
+    """
+    def __init__(self, room_ids, names, interval_s, attacks, arrival="fixed",
+                 burst_size=BURST_SIZE, burst_gap_s=BURST_GAP_S, rng=None):
+        assert arrival in ARRIVALS, f"Unknown arrival distribution: {arrival}"
+        assert attacks, "List of attacks is empty"
+        assert names, "List of names is empty"
+        self.room_ids = room_ids
+        self.names = names
+        self.interval_s = interval_s
+        self.attacks = attacks
+        self.arrival = arrival
+        self.burst_size = burst_size
+        self.burst_gap_s = burst_gap_s
+        self.rng = rng or random.Random()
+        if arrival == "bursty":
+            assert (burst_size - 1) * burst_gap_s < burst_size * interval_s, \
+                "Bursts are too long for the rate, lower --burst_gap"
+
+        self.start_time = None
+        self.in_flight = set()
+        self.sent = {room_id: 0 for room_id in room_ids}
+        self.failed = {room_id: 0 for room_id in room_ids}
+        self.latenesses = []
+
+    def get_gap(self, i):
+        """Seconds between message i and message i + 1."""
+        if self.arrival == "fixed":
+            return self.interval_s
+        if self.arrival == "poisson":
+            return self.rng.expovariate(1 / self.interval_s)
+        if (i + 1) % self.burst_size:
+            return self.burst_gap_s
+        mean_gap = self.burst_size * self.interval_s - (self.burst_size - 1) * self.burst_gap_s
+        return self.rng.expovariate(1 / mean_gap)
+
+    async def send(self, room_id, i, message_time):
+        self.latenesses.append(asyncio.get_running_loop().time() - message_time)
+        # Use the same haterbot name and attack sequence in every room
+        name = self.names[i % len(self.names)]
+        try:
+            await api.send_message({
+                "roomId": room_id,
+                "name": name,
+                "email": name + '@bot.bot',
+                "content": self.attacks[i % len(self.attacks)],
+            })
+            self.sent[room_id] += 1
+        except Exception as err:
+            print(f"Error sending attack to {room_id}: {err=}", file=sys.stderr)
+            self.failed[room_id] += 1
+
+    async def run_room(self, room_id):
+        loop = asyncio.get_running_loop()
+        message_time = self.start_time
+        i = 0
+        while True:
+            await asyncio.sleep(max(0, message_time - loop.time()))
+            task = asyncio.create_task(self.send(room_id, i, message_time))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+            message_time += self.get_gap(i)
+            i += 1
+
+    async def run(self, duration_s=None):
+        """
+        Send attacks until cancelled or for duration_s seconds, then wait for the POSTs in flight.
+        """
+        self.start_time = asyncio.get_running_loop().time()
+        tasks = [asyncio.create_task(self.run_room(room_id)) for room_id in self.room_ids]
+        try:
+            await asyncio.wait(tasks, timeout=duration_s)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.in_flight:
+                await asyncio.wait(self.in_flight)
+
+    def report(self):
+        elapsed_s = asyncio.get_running_loop().time() - self.start_time if self.start_time else 0
+        sent = sum(self.sent.values())
+        return {
+            "elapsed_s": elapsed_s,
+            "sent": sent,
+            "failed": sum(self.failed.values()),
+            "target_rate_per_room": 1 / self.interval_s,
+            "achieved_rate_per_room": {room_id: count / elapsed_s if elapsed_s else 0 for room_id, count in self.sent.items()},
+            "achieved_rate": sent / elapsed_s if elapsed_s else 0,
+            "lateness_s": utils.summarize(self.latenesses),
+        }
+
+def print_report(report):
+    print(f"Sent {report['sent']} attacks ({report['failed']} failed) in {report['elapsed_s']:.1f}s: "
+          f"{report['achieved_rate']:.3f} msg/s overall, target {report['target_rate_per_room']:.3f} msg/s per room")
+    for room_id, rate in report["achieved_rate_per_room"].items():
+        print(f"  {room_id}: {rate:.3f} msg/s")
+    sys.stdout.flush()
+
+async def print_reports(generator, interval_s):
+    while True:
+        await asyncio.sleep(interval_s)
+        print_report(generator.report())
 
 def get_parsed_args():
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Update frequency, names, and room IDs.")
-    
+
     # Add --freq argument
     parser.add_argument(
         '--freq',
         required=True,
-        type=float, 
-        help='Frequency value (float), defaults to 10.0'
+        type=float,
+        help='Seconds between messages in every room (mean for poisson and bursty arrivals)'
     )
-    
+
     # Add --names argument
     parser.add_argument(
         '--names',
         required=True,
         help='List of bot names'
     )
-    
+
     # Add mandatory --roomIds argument
     parser.add_argument(
         '--roomIds',
@@ -47,41 +160,48 @@ def get_parsed_args():
         help='Comma-separated list of room IDs'
     )
 
+    parser.add_argument('--arrival', default="fixed", choices=ARRIVALS, help='Distribution of the message arrivals (default: fixed)')
+    parser.add_argument('--burst_size', type=int, default=BURST_SIZE, help=f'Messages per burst for bursty arrivals (default: {BURST_SIZE})')
+    parser.add_argument('--burst_gap', type=float, default=BURST_GAP_S, help=f'Seconds between messages of a burst (default: {BURST_GAP_S})')
+    parser.add_argument('--duration', type=float, help='Stop after this many seconds (default: run until stopped)')
+    parser.add_argument('--report_interval', type=float, default=REPORT_INTERVAL_S, help=f'Seconds between rate reports (default: {REPORT_INTERVAL_S})')
+    parser.add_argument('--seed', type=int, help='Seed of the attack order and arrivals')
+
     # Parse the arguments
     return parser.parse_args()
 
-def process_parsed_args(args):
-    global FREQ, NAMES, room_ids
-    # Update the frequency if provided
-    if args.freq is not None:
-        FREQ = args.freq
-    # Update the number of names if provided
-    if args.names is not None:
-        NAMES = args.names.strip().strip(',').split(',')
-        assert len(NAMES) > 0, f"List of names is empty. Original string was {args.names}."
+def create_generator(args):
+    names = args.names.strip().strip(',').split(',')
+    assert len(names) > 0, f"List of names is empty. Original string was {args.names}."
     # Split the roomIds argument into a list
     room_ids = args.roomIds.strip(',').split(',')
 
-process_parsed_args(get_parsed_args())
-
-random.shuffle(NAMES)
-
-# Iterate over attack_cycle with enumerate to get index and content
-for i, content in enumerate(attack_cycle):
-    # Strip any extra whitespace from the content
-    content = content.strip()
-    
-    # Use the same haterbot name cyclically
-    name = NAMES[i % len(NAMES)]
-    
-    # Iterate over each roomId and send the message
-    for room_id in room_ids:
-        response = api.send_message({
-            "roomId": room_id,
-            "name": name,
-            "email": name + '@bot.bot',
-            "content": content,
-        })
-    
-    # Wait for the specified time interval before the next message
-    time.sleep(FREQ)
+    # Shuffle the attacks and names for a random permutation
+    rng = random.Random(args.seed)
+    attacks = load_attacks()
+    rng.shuffle(attacks)
+    rng.shuffle(names)
+    return HaterbotGenerator(room_ids, names, args.freq, attacks, args.arrival, args.burst_size, args.burst_gap, rng)
+
+async def main(args):
+    generator = create_generator(args)
+
+    # Stopping the process from the frontend sends SIGTERM, report before exiting
+    main_task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+
+    reporter = asyncio.create_task(print_reports(generator, args.report_interval))
+    try:
+        await generator.run(args.duration)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        reporter.cancel()
+        print_report(generator.report())
+        await api.close()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(get_parsed_args()))
+    except KeyboardInterrupt:
+        pass
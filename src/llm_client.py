@@ -1,59 +1,174 @@
+import asyncio
 import groq, openai
 import time
 
+import clock
+import context_window
+import llm_router
+import llm_scheduler
+import metrics
+import tracing
 import utils
 
 MODEL_NAME = None
+STREAM = False      # --stream
 
-def get_client(model):
+def get_provider(model):
     if any(substr in model for substr in ["llama", "distil", "gemma", "mixtral"]):
-        return groq.Groq(api_key=utils.get_api_key("GROQ"))
+        return "groq"
     else:
-        return openai.OpenAI(api_key=utils.get_api_key("OPENAI"))
+        return "openai"
+
+def get_timeout(deadline):
+    """
+    Time left until the deadline (a clock.now() timestamp), None for no deadline.
+    """
+    return None if deadline is None else max(0, deadline - clock.now())
+
+def get_client(model):
+    # Retries are left to llm_scheduler, which backs off the whole provider
+    if get_provider(model) == "groq":
+        return groq.AsyncGroq(api_key=utils.get_api_key("GROQ"), max_retries=0)
+    else:
+        return openai.AsyncOpenAI(api_key=utils.get_api_key("OPENAI"), max_retries=0)
 
 class LLMClient():
-    def __init__(self, settings, logger):
+    """
+    Asynchronous LLM client. Completions never block the event loop, so several bots can have
+    completions in flight at once. Every call works on its own copy of the settings, and can be
+    cancelled by cancelling the awaiting task.
+    """
+    def __init__(self, settings, logger, name=None):
         self.settings = settings
         self.logger = logger
-        self.client = get_client(settings["model"])
-        self.logger.info(f'Created LLMClient: Model: {settings["model"]}')
+        self.name = name or logger.name     # Bot label of the metrics
 
-    def get_response_from_completion(self, completion_settings):
-        self.logger.debug(f'Completion settings {completion_settings}')
-        if utils.OFFLINE: return "Lorem ipsum"
-        completion_response = self.client.chat.completions.create(**completion_settings)
+        # Several equivalent models can be given separated by commas, the router picks one for each request
+        self.router = llm_router.Router([
+            llm_router.Backend(model, get_client(model), get_provider(model))
+            for model in settings["model"].split(',')
+        ], logger)
+        self.logger.info('Created LLMClient: Model: %s', settings["model"])
+
+    async def close(self):
+        """
+        Close the connections of the client of every backend.
+        """
+        for backend in self.router.backends:
+            if hasattr(backend.client, "close"):
+                await backend.client.close()
+
+    async def create_completion(self, backend, completion_settings, deadline=None, sent=None):
+        """
+        Send the request to the backend through the scheduler shared by all bots.
+        sent() is called whenever the request is actually sent, once the scheduler allowed it.
+        """
+        completion_settings = dict(completion_settings, model=backend.model)
+        return await llm_scheduler.run(
+            backend.provider, completion_settings, deadline,
+            lambda: self.request(backend, completion_settings, sent),
+            self.logger)
+
+    async def request(self, backend, completion_settings, sent=None):
+        """
+        Send the request, recording its metrics (for streams, the duration until the stream starts).
+        """
+        labels = {"bot": self.name, "model": backend.model}
+        if sent is not None:
+            sent()
+        start_time = time.perf_counter()
+        try:
+            with tracing.span("llm request", model=backend.model):
+                response = await backend.client.chat.completions.create(**completion_settings)
+        except Exception:
+            metrics.LLM_ERRORS.inc(**labels)
+            raise
+        metrics.LLM_DURATION.observe(time.perf_counter() - start_time, **labels)
+
+        # Prefer the token counts of the provider, streams and some clients do not include them
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        if prompt_tokens is None:
+            prompt_tokens = sum(context_window.count_tokens(msg["content"]) for msg in completion_settings["messages"])
+        metrics.LLM_PROMPT_TOKENS.observe(prompt_tokens, **labels)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        if completion_tokens is None and not completion_settings.get("stream"):
+            completion_tokens = len(response.choices[0].message.content or '') // context_window.CHARS_PER_TOKEN
+        if completion_tokens is not None:
+            metrics.LLM_COMPLETION_TOKENS.inc(completion_tokens, **labels)
+        return response
+
+    async def get_response_from_backend(self, backend, completion_settings, deadline=None, sent=None):
+        completion_response = await self.create_completion(backend, completion_settings, deadline, sent)
         response = completion_response.choices[0].message.content.strip()
         if len(response) == 0:
             raise Exception("Returned empty response")
         return response
 
-    def complete_from_message(self, message, system_prompt = None):
+    async def get_response_from_completion(self, completion_settings, deadline=None):
+        self.logger.debug('Completion settings %s', completion_settings)
+        if utils.OFFLINE: return "Lorem ipsum"
+        # A reply past its deadline is useless, so the requests (and their hedges) are cancelled then
+        return await asyncio.wait_for(self.router.complete(
+            lambda backend, sent: self.get_response_from_backend(backend, completion_settings, deadline, sent)),
+            get_timeout(deadline))
+
+    async def complete_from_message(self, message, system_prompt = None):
         start_time = time.time()
-        
+
         completion_settings = self.settings.copy()
         completion_settings["messages"] = [{"role": "user", "content": message}]
         if system_prompt: completion_settings["messages"].append({"role": "system", "content": system_prompt})
-        
-        response_text = self.get_response_from_completion(completion_settings)
-        
+
+        response_text = await self.get_response_from_completion(completion_settings)
+
         end_time = time.time()
         execution_time = end_time - start_time
-        
-        self.logger.info(f'Completed message ending in {message[-100:]}, response starts with {response_text[:100]}')
-        self.logger.info(f'Execution time: {execution_time:.2f} seconds')
-        
+
+        self.logger.info('Completed message ending in %s, response starts with %s', message[-100:], response_text[:100])
+        self.logger.info('Execution time: %.2f seconds', execution_time)
+
         return response_text
 
-    def continue_conversation(self, messages):
-        self.logger.info(f'Continuing conversation ending in {messages[-1]["content"][-100:]}')
-        completion_settings = self.settings
+    async def continue_conversation(self, messages, deadline=None):
+        self.logger.info('Continuing conversation ending in %s', messages[-1]["content"][-100:])
+        completion_settings = self.settings.copy()
         completion_settings["messages"] = messages
         try:
-            response_text = self.get_response_from_completion(completion_settings)
+            response_text = await self.get_response_from_completion(completion_settings, deadline)
         except Exception as err:
             utils.print_json(completion_settings, True)
-            self.logger.error(f"Unexpected {err=}, {type(err)=} when requesting LLM completion")
+            self.logger.error("Unexpected err=%r, type(err)=%r when requesting LLM completion", err, type(err))
             return None
-        self.logger.info(f'Response starts with {response_text[:100]}')
+        self.logger.info('Response starts with %s', response_text[:100])
         return response_text
 
+    async def stream_conversation(self, messages, deadline=None):
+        """
+        Stream the completion of the conversation, yielding text chunks as soon as they are generated.
+        Closing the generator early (e.g. on a refusal) closes the underlying stream.
+        """
+        self.logger.info('Streaming conversation ending in %s', messages[-1]["content"][-100:])
+        completion_settings = self.settings.copy()
+        completion_settings["messages"] = messages
+        completion_settings["stream"] = True
+        self.logger.debug('Completion settings %s', completion_settings)
+        if utils.OFFLINE:
+            yield "Lorem ipsum"
+            return
+
+        # Streams are not hedged, they just go to the best backend
+        backend = self.router.rank()[0]
+        stream = await asyncio.wait_for(self.router.attempt(
+            llm_router.Attempt(backend),
+            lambda backend, sent: self.create_completion(backend, completion_settings, deadline, sent)),
+            get_timeout(deadline))
+        streamed_chars = 0
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    streamed_chars += len(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            metrics.LLM_COMPLETION_TOKENS.inc(streamed_chars // context_window.CHARS_PER_TOKEN, bot=self.name, model=backend.model)
+            await stream.close()
@@ -0,0 +1,180 @@
+"""
+Latency-aware router over equivalent models (backends), possibly on different providers.
+Tracks the rolling latency percentiles and error rate of each backend, sends every request to the
+fastest healthy one and, if it has not answered after a percentile of its usual latency, sends a
+hedged duplicate to the next one. The first valid answer wins and the other request is cancelled.
+Latencies are measured from when a request is sent, after waiting for llm_scheduler.
+"""
+import asyncio
+from collections import deque
+
+import clock
+
+HEDGE_PERCENTILE = 95       # Hedge once the request took longer than this percentile of the backend latency
+HEDGE_DEFAULT_DELAY_S = 10  # Hedge delay while there are not enough latency samples
+LATENCY_WINDOW = 50         # Number of recent calls used for the latency percentiles
+ERROR_WINDOW = 20           # Number of recent calls used for the error rate
+MIN_SAMPLES = 5             # Samples needed before percentiles and error rates are trusted
+MAX_ERROR_RATE = 0.5        # Backends above this error rate are unhealthy
+UNHEALTHY_COOLDOWN_S = 60   # Unhealthy backends are tried again after this long without errors
+
+def get_percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+class Backend:
+    def __init__(self, model, client=None, provider=None):
+        self.model = model
+        self.client = client
+        self.provider = provider
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # (latency, True if exact or False if only a lower bound)
+        self.outcomes = deque(maxlen=ERROR_WINDOW)  # True for success, False for error
+        self.last_error_time = 0
+
+    def percentile(self, q):
+        exact = [latency for latency, is_exact in self.latencies if is_exact]
+        if len(exact) < MIN_SAMPLES:
+            return None
+        estimate = get_percentile(exact, q)
+        # Requests that lost to a hedge only took at least their latency, which says nothing about
+        # the percentile unless they are above it
+        return get_percentile(exact + [latency for latency, is_exact in self.latencies
+                                       if not is_exact and latency > estimate], q)
+
+    def error_rate(self):
+        if len(self.outcomes) < MIN_SAMPLES:
+            return 0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def is_healthy(self):
+        return self.error_rate() <= MAX_ERROR_RATE or clock.now() - self.last_error_time > UNHEALTHY_COOLDOWN_S
+
+    def record(self, latency_s, success):
+        self.outcomes.append(success)
+        if success:
+            self.latencies.append((latency_s, True))
+        else:
+            self.last_error_time = clock.now()
+
+    def record_lower_bound(self, latency_s):
+        self.latencies.append((latency_s, False))
+
+    def __repr__(self):
+        return f'Backend({self.model}, p50={self.percentile(50)}, p95={self.percentile(95)}, errors={self.error_rate():.2f})'
+
+class Attempt:
+    """
+    Request to a backend. The request calls sent() once it is actually sent (after waiting for the
+    scheduler, and again on retries), its latency counts from then.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.start_time = clock.now()
+        self.sent_time = None
+        self.lost = False   # Cancelled by the router because another backend answered first
+        self.hedged = False # Already hedged, each attempt triggers at most one hedge
+
+    def sent(self):
+        self.sent_time = clock.now()
+
+    def latency(self):
+        return clock.now() - (self.start_time if self.sent_time is None else self.sent_time)
+
+class Router:
+    def __init__(self, backends, logger=None):
+        assert backends, "The router needs at least one backend"
+        self.backends = backends
+        self.logger = logger
+
+    def rank(self):
+        """
+        Backends from the most to the least preferred: healthy ones by median latency (backends
+        without samples first, so they get measured), then unhealthy ones as a last resort.
+        """
+        def key(backend):
+            median = backend.percentile(50)
+            return (not backend.is_healthy(), 0 if median is None else median)
+        return sorted(self.backends, key=key)
+
+    async def attempt(self, attempt, call):
+        """
+        Run call(backend, sent) for the Attempt, recording the outcome and latency of its backend.
+        """
+        backend = attempt.backend
+        try:
+            response = await call(backend, attempt.sent)
+        except asyncio.CancelledError:
+            # Only a request that lost to a hedge after being sent tells something about the latency
+            # (at least this long), not the ones cancelled by the caller
+            if attempt.lost and attempt.sent_time is not None:
+                backend.record_lower_bound(attempt.latency())
+            raise
+        except Exception:
+            backend.record(attempt.latency(), False)
+            raise
+        backend.record(attempt.latency(), True)
+        return response
+
+    async def complete(self, call):
+        """
+        Run call(backend, sent), a coroutine function returning the response text and calling sent()
+        once the request is sent, on the best backend, hedging and failing over to the next ones.
+        Raises the last error if every backend failed.
+        """
+        candidates = self.rank()
+        tasks = {}
+        last_error = None
+        launch = True
+        try:
+            while True:
+                # Launch the next backend: first request, hedge after a timeout or failover after an error
+                if launch and candidates:
+                    backend = candidates.pop(0)
+                    if tasks and self.logger:
+                        self.logger.info('Hedging LLM request to %s', backend.model)
+                    attempt = Attempt(backend)
+                    tasks[asyncio.create_task(self.attempt(attempt, call))] = attempt
+                elif not tasks:
+                    raise last_error
+                launch = False
+
+                # Only wait for the hedge delay if there is another backend to hedge to
+                unhedged = [attempt for attempt in tasks.values() if not attempt.hedged]
+                timeout = None
+                if candidates and unhedged:
+                    timeout = max(0, min(self.get_hedge_time(attempt) for attempt in unhedged) - clock.now())
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Requests still waiting for the scheduler are not hedged yet
+                    due = [attempt for attempt in unhedged
+                           if attempt.sent_time is not None and self.get_hedge_time(attempt) <= clock.now()]
+                    for attempt in due:
+                        attempt.hedged = True
+                    launch = bool(due)
+
+                for task in done:
+                    backend = tasks.pop(task).backend
+                    if task.exception() is None and task.result():
+                        for attempt in tasks.values():
+                            attempt.lost = True
+                        return task.result()
+                    last_error = task.exception() or Exception(f"{backend.model} returned an empty response")
+                    launch = True
+                    if self.logger:
+                        self.logger.warning('LLM request to %s failed: %r', backend.model, last_error)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def get_hedge_delay(backend):
+        delay = backend.percentile(HEDGE_PERCENTILE)
+        return HEDGE_DEFAULT_DELAY_S if delay is None else delay
+
+    @classmethod
+    def get_hedge_time(cls, attempt):
+        """
+        Time after which the attempt is hedged, counted from when it was sent (from now if it is still queued).
+        """
+        sent_time = clock.now() if attempt.sent_time is None else attempt.sent_time
+        return sent_time + cls.get_hedge_delay(attempt.backend)
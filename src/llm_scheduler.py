@@ -0,0 +1,162 @@
+"""
+Process-wide scheduler of the LLM requests of all bots.
+Each provider (or model with its own limits) can get token buckets limiting its requests and tokens
+per minute (--rate_limit, unlimited by default), and waiting requests are served by earliest deadline
+first, so the replies closest to MAX_RESPONSE_DURATION_S go first.
+Rate limit errors (429) make the whole provider back off before the request is retried.
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+
+import groq, openai
+
+import clock
+import context_window
+import tracing
+
+# Limits by provider or model (e.g. "groq" or "llama3-70b-8192"), set with --rate_limit to the plan of
+# the API keys used. Requests are not limited unless configured; a model with its own limits gets its
+# own queue, separate from the other models of its provider.
+RATE_LIMITS: dict[str, dict] = {}
+
+RESPONSE_TOKENS_ESTIMATE = 256  # Tokens counted for the response when max_tokens is not set
+MAX_RETRIES = 4                 # Retries of a request after a rate limit error
+BACKOFF_BASE_S = 1.0            # Backoff after the first rate limit error, doubled on every retry
+BACKOFF_MAX_S = 60.0
+
+RATE_LIMIT_ERRORS = (groq.RateLimitError, openai.RateLimitError)
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.last_update = clock.now()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def time_until(self, amount, now):
+        """Seconds until amount can be consumed (requests above capacity only wait for a full bucket)."""
+        self.refill(now)
+        return max(0, min(amount, self.capacity) - self.tokens) / self.rate
+
+    def consume(self, amount, now):
+        self.refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+class ProviderQueue:
+    def __init__(self, provider):
+        limits = RATE_LIMITS.get(provider, {})
+        self.provider = provider
+        self.requests = TokenBucket(limits["requests_per_minute"]) if limits.get("requests_per_minute") else None
+        self.tokens = TokenBucket(limits["tokens_per_minute"]) if limits.get("tokens_per_minute") else None
+        self.backoff_until = 0
+        self.waiting = []   # Heap of (deadline, order, tokens, future)
+        self.order = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def acquire(self, tokens, deadline):
+        """
+        Wait until the request is allowed to be sent.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (deadline, next(self.order), tokens, future))
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        await future
+
+    def back_off(self, delay_s):
+        self.backoff_until = max(self.backoff_until, clock.now() + delay_s)
+
+    async def run(self):
+        while True:
+            # Forget requests whose caller was cancelled
+            while self.waiting and self.waiting[0][3].done():
+                heapq.heappop(self.waiting)
+            if not self.waiting:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            _, _, tokens, future = self.waiting[0]
+            now = clock.now()
+            wait_s = max(self.backoff_until - now,
+                         self.requests.time_until(1, now) if self.requests else 0,
+                         self.tokens.time_until(tokens, now) if self.tokens else 0)
+            if wait_s > 0:
+                # Wake up early if a new request arrives, it may be more urgent
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.waiting)
+            if self.requests:
+                self.requests.consume(1, now)
+            if self.tokens:
+                self.tokens.consume(tokens, now)
+            future.set_result(None)
+
+provider_queues: dict[str, ProviderQueue] = {}
+
+def get_provider_queue(provider, model=None) -> ProviderQueue:
+    # Models with their own limits are queued separately
+    key = model if model in RATE_LIMITS else provider
+    if key not in provider_queues:
+        provider_queues[key] = ProviderQueue(key)
+    return provider_queues[key]
+
+def parse_rate_limit(text):
+    """
+    Parse a --rate_limit value, NAME=REQUESTS_PER_MINUTE[:TOKENS_PER_MINUTE], into (NAME, limits).
+    """
+    name, _, limits = text.partition('=')
+    requests_per_minute, _, tokens_per_minute = limits.partition(':')
+    try:
+        limits = {"requests_per_minute": int(requests_per_minute) if requests_per_minute else None,
+                  "tokens_per_minute": int(tokens_per_minute) if tokens_per_minute else None}
+    except ValueError:
+        limits = None
+    if not name or not limits or not any(limits.values()):
+        raise argparse.ArgumentTypeError(f"expected NAME=REQUESTS_PER_MINUTE[:TOKENS_PER_MINUTE], got {text!r}")
+    return name, limits
+
+def estimate_tokens(completion_settings):
+    prompt_tokens = sum(context_window.count_tokens(msg["content"]) for msg in completion_settings["messages"])
+    return prompt_tokens + completion_settings.get("max_tokens", RESPONSE_TOKENS_ESTIMATE)
+
+def get_backoff_s(err, attempt):
+    # Follow the retry-after header of the provider if there is one
+    try:
+        return min(float(err.response.headers["retry-after"]), BACKOFF_MAX_S)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return min(BACKOFF_BASE_S * 2 ** attempt, BACKOFF_MAX_S)
+
+async def run(provider, completion_settings, deadline, call, logger=None):
+    """
+    Run call() (a coroutine function sending the request) once the provider allows it.
+    Requests with the earliest deadline (a clock.now() timestamp, None for no deadline) go first.
+    """
+    queue = get_provider_queue(provider, completion_settings.get("model"))
+    tokens = estimate_tokens(completion_settings)
+    deadline = float('inf') if deadline is None else deadline
+    for attempt in range(MAX_RETRIES + 1):
+        with tracing.span("llm queue", provider=provider, attempt=attempt):
+            await queue.acquire(tokens, deadline)
+        try:
+            return await call()
+        except RATE_LIMIT_ERRORS as err:
+            if attempt == MAX_RETRIES:
+                raise
+            backoff_s = get_backoff_s(err, attempt)
+            if logger:
+                logger.warning('Rate limited by %s, backing off for %.1fs (attempt %d)', provider, backoff_s, attempt + 1)
+            queue.back_off(backoff_s)
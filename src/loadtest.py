@@ -0,0 +1,280 @@
+"""
+End-to-end load test of the bots, fully offline.
+Starts an in-process stand-in for /api/messages and replaces the LLM providers with a mock with
+configurable latency, token rate and error injection. Then it drives real LLMBot and MessageMonitor
+instances across several rooms under a haterbot flood, and reports throughput, poll latency, LLM
+latency, reply latency percentiles and event loop lag as JSON.
+
+Usage: python3 src/loadtest.py --bots 100 --rooms 30 --duration 60 --speedup 10
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+import types
+
+import httpx
+import openai
+
+import api
+import chatbot
+import hate_speech_generator
+import llm_client
+import llm_scheduler
+import message_monitor
+import metrics
+import prompt_cache
+import stand_in_server
+import tracing
+import utils
+
+HATER_NAME = "LoadTestHater"
+
+def parse_distribution(spec):
+    """
+    Parse a latency distribution like "fixed:1", "uniform:0.5,2", "exponential:1" (mean)
+    or "lognormal:1,0.5" (median, sigma), returning a function that samples it in seconds.
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',') if value]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exponential":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda: values[0] * random.lognormvariate(0, values[1])
+    raise ValueError(f"Unknown distribution {spec}")
+
+class MockStream:
+    def __init__(self, chunks, chunk_delay_s):
+        self.chunks = chunks
+        self.chunk_delay_s = chunk_delay_s
+
+    async def __aiter__(self):
+        for i, chunk in enumerate(self.chunks):
+            if i > 0:
+                await asyncio.sleep(self.chunk_delay_s)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=chunk))])
+
+    async def close(self):
+        pass
+
+class MockLLM:
+    """
+    Stand-in for the groq/openai async clients, only implementing chat.completions.create.
+    """
+    def __init__(self, args):
+        self.first_token_latency = parse_distribution(args.llm_latency)
+        self.token_rate = args.llm_token_rate
+        self.response_tokens = args.llm_response_tokens
+        self.error_rate = args.llm_error_rate
+        self.rate_limit_rate = args.llm_rate_limit_rate
+        self.latencies = []
+        self.calls = 0
+        self.errors = 0
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, **settings):
+        self.calls += 1
+        start_time = time.time()
+        await asyncio.sleep(self.first_token_latency())
+
+        # Inject errors
+        if random.random() < self.rate_limit_rate:
+            self.errors += 1
+            response = httpx.Response(429, request=httpx.Request("POST", "http://mock-llm"))
+            raise openai.RateLimitError("Mock rate limit", response=response, body=None)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise Exception("Mock LLM error")
+
+        words = [f"word{i}" for i in range(self.response_tokens)]
+        if settings.get("stream"):
+            self.latencies.append(time.time() - start_time)
+            return MockStream([f" {word}" for word in words], 1 / self.token_rate)
+
+        await asyncio.sleep(self.response_tokens / self.token_rate)
+        self.latencies.append(time.time() - start_time)
+        message = types.SimpleNamespace(content="Mock reply " + " ".join(words))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+async def measure_loop_lag(lags, interval_s=0.1):
+    while True:
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval_s)
+        lags.append(time.perf_counter() - start_time - interval_s)
+
+def instrument_monitor(monitor, poll_latencies):
+    fetch_messages = monitor.fetch_messages
+    async def timed_fetch_messages(*args):
+        start_time = time.perf_counter()
+        try:
+            return await fetch_messages(*args)
+        finally:
+            poll_latencies.append(time.perf_counter() - start_time)
+    monitor.fetch_messages = timed_fetch_messages
+
+async def start_bot(bot_desc, startup_durations):
+    """
+    Returns whether the bot started (startup LLM calls may fail with error injection).
+    """
+    start_time = time.time()
+    try:
+        bot = chatbot.LLMBot(bot_desc)
+        await bot.start_bot()
+    except Exception as err:
+        print(f"Bot {bot_desc['username']} failed to start: {err=}", file=sys.stderr)
+        return False
+    message_monitor.get_room_monitor(bot_desc["chatroom"]).subscribe(bot)
+    startup_durations.append(time.time() - start_time)
+    return True
+
+def get_reply_latencies(store, bot_names):
+    """
+    Time between each bot message and the last haterbot message before it in the same room.
+    """
+    latencies = []
+    for messages in store.rooms.values():
+        last_hater_time = None
+        for msg in messages:
+            timestamp = message_monitor.parse_timestamp(msg["timestamp"]).timestamp()
+            if msg["name"] == HATER_NAME:
+                last_hater_time = timestamp
+            elif msg["name"] in bot_names and last_hater_time is not None:
+                latencies.append(timestamp - last_hater_time)
+    return latencies
+
+async def run(args):
+    store = stand_in_server.MessageStore()
+    runner = await stand_in_server.start_server(port=args.port, store=store)
+    api.BASE_API_URL = f"http://localhost:{args.port}/api/messages"
+
+    # Replace the providers by the mock LLM
+    mock = MockLLM(args)
+    llm_client.get_client = lambda model: mock
+    llm_client.get_provider = lambda model: "mock"
+    llm_scheduler.RATE_LIMITS["mock"] = {
+        "requests_per_minute": args.llm_requests_per_minute,
+        "tokens_per_minute": args.llm_tokens_per_minute,
+    }
+
+    room_ids = [f"loadtest{i}" for i in range(args.rooms)]
+    bot_descs = [{
+        "bot-description": args.bot_description,
+        "username": f"LoadTestBot{i}",
+        "email": f"loadtestbot{i}@bot.bot",
+        "chatroom": room_ids[i % len(room_ids)],
+        "role": args.role,
+        "enable": "true",
+    } for i in range(args.bots)]
+    bot_names = {bot_desc["username"] for bot_desc in bot_descs}
+
+    poll_latencies, loop_lags, startup_durations = [], [], []
+    tasks = [asyncio.create_task(measure_loop_lag(loop_lags))]
+
+    start_time = time.time()
+    started = await asyncio.gather(*(start_bot(bot_desc, startup_durations) for bot_desc in bot_descs))
+    startup_s = time.time() - start_time
+
+    for room_id in room_ids:
+        message_monitor.get_room_monitor(room_id)
+    for monitor in message_monitor.room_monitors.values():
+        instrument_monitor(monitor, poll_latencies)
+        tasks.append(asyncio.create_task(monitor.start_monitoring()))
+    haterbots = hate_speech_generator.HaterbotGenerator(
+        room_ids, [HATER_NAME], args.hater_interval, hate_speech_generator.load_attacks(), args.hater_arrival)
+    tasks.append(asyncio.create_task(haterbots.run()))
+
+    await asyncio.sleep(args.duration)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await api.close()
+    await runner.cleanup()
+
+    messages = [msg for room in store.rooms.values() for msg in room]
+    bot_messages = sum(msg["name"] in bot_names for msg in messages)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "bots_started": sum(started),
+        "startup_s": startup_s,
+        "startup_per_bot_s": utils.summarize(startup_durations),
+        "messages": len(messages),
+        "bot_messages": bot_messages,
+        "hater_messages": haterbots.report(),
+        "bot_messages_per_s": bot_messages / args.duration,
+        "polls": len(poll_latencies),
+        "polls_per_s": len(poll_latencies) / args.duration,
+        "poll_latency_s": utils.summarize(poll_latencies),
+        "llm_calls": mock.calls,
+        "llm_errors": mock.errors,
+        "llm_latency_s": utils.summarize(mock.latencies),
+        "reply_latency_s": utils.summarize(get_reply_latencies(store, bot_names)),
+        "event_loop_lag_s": utils.summarize(loop_lags),
+        "metrics": metrics.to_json()["metrics"] if args.metrics else None,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test of the bots.")
+    parser.add_argument("--bots", type=int, default=100, help="Number of bots (default: 100)")
+    parser.add_argument("--rooms", type=int, default=30, help="Number of rooms the bots are spread across (default: 30)")
+    parser.add_argument("--duration", type=float, default=60, help="Duration of the test in seconds (default: 60)")
+    parser.add_argument("--speedup", type=float, default=10.0, help="Speed up factor of the bots (default: 10)")
+    parser.add_argument("--hater_interval", type=float, default=5.0, help="Seconds between haterbot messages in every room (default: 5)")
+    parser.add_argument("--hater_arrival", default="fixed", choices=hate_speech_generator.ARRIVALS, help="Distribution of the haterbot messages (default: fixed)")
+    parser.add_argument("--bot_description", default="AntiHaterBot", help="Folder in assets/bot-descriptions used by every bot")
+    parser.add_argument("--role", default="simple", choices=["simple", "elaborated"], help="Role of every bot (default: simple)")
+    parser.add_argument("--stream", action="store_true", help="Stream LLM completions")
+    parser.add_argument("--speculative", action="store_true", help="Generate replies while the bots are reading")
+    parser.add_argument("--llm_latency", default="lognormal:0.8,0.5", help="Distribution of the time to first token (default: lognormal:0.8,0.5)")
+    parser.add_argument("--llm_token_rate", type=float, default=200, help="Tokens per second generated by the mock LLM (default: 200)")
+    parser.add_argument("--llm_response_tokens", type=int, default=40, help="Tokens of every mock response (default: 40)")
+    parser.add_argument("--llm_error_rate", type=float, default=0.0, help="Probability of a mock LLM error (default: 0)")
+    parser.add_argument("--llm_rate_limit_rate", type=float, default=0.0, help="Probability of a mock 429 error (default: 0)")
+    parser.add_argument("--llm_requests_per_minute", type=int, default=100000, help="Request limit enforced by the scheduler")
+    parser.add_argument("--llm_tokens_per_minute", type=int, default=100000000, help="Token limit enforced by the scheduler")
+    parser.add_argument("--delivery", default=message_monitor.DELIVERY, choices=message_monitor.DELIVERIES, help="How the monitors receive new messages (default: auto, long-poll)")
+    parser.add_argument("--port", type=int, default=3999, help="Port of the stand-in server (default: 3999)")
+    parser.add_argument("--metrics", action="store_true", help="Include the metrics registry of the bots in the report")
+    parser.add_argument("--trace_sample", type=float, default=0.0, help="Fraction of the messages and replies traced (default: 0)")
+    parser.add_argument("--trace_file", default="output/traces/loadtest.json", help="Chrome trace-event JSON file of the traces")
+    parser.add_argument("--log", action="store_true", help="Keep the logs and prints of the bots")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    utils.SPEED_UP_FACTOR = args.speedup
+    llm_client.MODEL_NAME = "mock-llm"
+    llm_client.STREAM = args.stream
+    chatbot.SPECULATIVE = args.speculative
+    prompt_cache.CACHE_ENABLED = False
+    tracing.TRACE_SAMPLE_RATE = args.trace_sample
+    message_monitor.DELIVERY = args.delivery
+
+    if args.log:
+        report = asyncio.run(run(args))
+    else:
+        logging.disable(logging.INFO)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report = asyncio.run(run(args))
+
+    if tracing.TRACE_SAMPLE_RATE > 0:
+        tracing.export(args.trace_file)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,22 @@ import asyncio
 import argparse
 import csv
 import faulthandler
+import os
+import signal
 import time
 import sys
 
+import api
 import chatbot
+import checkpoint
+import context_window
 import llm_client
-from message_monitor import MessageMonitor  # Import the new MessageMonitor class
+import llm_scheduler
+import message_monitor
+import metrics
+import prompt_cache
+import supervisor
+import tracing
 import utils
 
 faulthandler.enable()
@@ -48,12 +58,33 @@ def parse_args():
         help='Bots will start participating right away with a default message'
     )
     
+    # Add optional --stream flag (no extra param, just a flag)
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Stream LLM completions, so bots start typing as soon as the first token arrives'
+    )
+
+    # Add optional --speculative flag (no extra param, just a flag)
+    parser.add_argument(
+        '--speculative',
+        action='store_true',
+        help='Generate replies while the bots are still reading the messages, restarting if more messages arrive'
+    )
+
+    # Add optional --no_cache flag (no extra param, just a flag)
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help='Always call the LLM for self-reflections and greetings instead of reusing those of previous runs'
+    )
+
     # Adding mandatory model argument
     parser.add_argument(
         '--model',
         type=str,
         required=True,
-        help='Specify the model to be used (e.g., llama3-8b-8192)'
+        help='Specify the model to be used (e.g., llama3-8b-8192). Several equivalent models can be given separated by commas (e.g., llama3-70b-8192,gpt-4o), each request then goes to the fastest one'
     )
 
     # Adding optional delay_seconds argument
@@ -63,6 +94,130 @@ def parse_args():
         help='Delay initialization by a specified number of seconds'
     )
 
+    # Adding optional startup_parallelism argument
+    parser.add_argument(
+        '--startup_parallelism',
+        type=int,
+        default=8,
+        help='Maximum number of bots being constructed and started at the same time (default: 8)'
+    )
+
+    # Adding optional context_tokens argument
+    parser.add_argument(
+        '--context_tokens',
+        type=int,
+        default=context_window.CONTEXT_TOKEN_BUDGET,
+        help=f'Maximum number of tokens of conversation context sent to the LLM (default: {context_window.CONTEXT_TOKEN_BUDGET})'
+    )
+
+    # Add optional --summarize flag (no extra param, just a flag)
+    parser.add_argument(
+        '--summarize',
+        action='store_true',
+        help='Keep a rolling summary of the messages that no longer fit in the context sent to the LLM'
+    )
+
+    # Adding optional message delivery arguments
+    parser.add_argument(
+        '--delivery',
+        choices=message_monitor.DELIVERIES,
+        default=message_monitor.DELIVERY,
+        help='How new messages are received: "auto" long-polls the server and falls back to adaptive polling if it does not support it, "poll" only polls (default: auto)'
+    )
+    parser.add_argument(
+        '--max_poll_interval',
+        type=float,
+        default=message_monitor.POLL_MAX_INTERVAL_S,
+        help=f'Longest interval (in simulated seconds) between polls of an idle room (default: {message_monitor.POLL_MAX_INTERVAL_S})'
+    )
+
+    # Adding optional rate_limit argument
+    parser.add_argument(
+        '--rate_limit',
+        type=llm_scheduler.parse_rate_limit,
+        action='append',
+        default=[],
+        metavar='NAME=RPM[:TPM]',
+        help='Limit the LLM requests (and tokens) per minute of a provider or model, e.g. groq=30:6000 or llama3-70b-8192=30. Can be repeated, requests are not limited by default (limits apply to each shard)'
+    )
+
+    # Adding optional metrics arguments
+    parser.add_argument(
+        '--metrics_port',
+        type=int,
+        help='Serve the metrics on this local port, at /metrics (Prometheus text format) and /metrics.json'
+    )
+    parser.add_argument(
+        '--metrics_file',
+        type=str,
+        help='Periodically write a JSON snapshot of the metrics to this file (e.g., output/metrics/EXPERIMENT_NAME.json)'
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        default=metrics.SNAPSHOT_INTERVAL_S,
+        help=f'Seconds between snapshots of --metrics_file (default: {metrics.SNAPSHOT_INTERVAL_S})'
+    )
+
+    # Adding optional tracing arguments
+    parser.add_argument(
+        '--trace_sample',
+        type=float,
+        default=tracing.TRACE_SAMPLE_RATE,
+        help='Fraction of the messages and replies traced (default: 0, no tracing)'
+    )
+    parser.add_argument(
+        '--trace_file',
+        type=str,
+        help='Chrome trace-event JSON file the traces are written to on exit (default: output/traces/EXPERIMENT_NAME.json)'
+    )
+
+    # Adding optional checkpoint arguments
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Restore the conversation state of the bots from --checkpoint_file, instead of re-reading the rooms from the start'
+    )
+    parser.add_argument(
+        '--checkpoint_file',
+        type=str,
+        help='File the conversation state of the bots is periodically written to (default: output/checkpoints/EXPERIMENT_NAME.json)'
+    )
+    parser.add_argument(
+        '--checkpoint_interval',
+        type=float,
+        default=checkpoint.CHECKPOINT_INTERVAL_S,
+        help=f'Seconds between checkpoints (default: {checkpoint.CHECKPOINT_INTERVAL_S})'
+    )
+
+    # Adding optional reload arguments
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Reload the experiment description when it changes, only starting and stopping the bots of the changed rows (SIGHUP also reloads it)'
+    )
+    parser.add_argument(
+        '--watch_interval',
+        type=float,
+        default=1,
+        help='Seconds between checks of the experiment description for --watch (default: 1)'
+    )
+
+    # Adding optional sharding arguments
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=1,
+        help='Run the bots in this many worker processes, each one with a share of the rooms (default: 1)'
+    )
+    parser.add_argument(
+        '--rooms',
+        type=str,
+        help='Only run the bots of these comma-separated rooms'
+    )
+    # Index of the shard run by this process, set by the supervisor
+    parser.add_argument('--shard', type=int, help=argparse.SUPPRESS)
+
     # Adding mandatory max_time_to_response argument with default 60 seconds
     parser.add_argument(
         '--max_time_to_response',
@@ -93,6 +248,23 @@ def process_args(args):
         utils.OFFLINE = args.offline
         print(f"Offline flag set to: {utils.OFFLINE}", file=sys.stderr)
     
+    # Set STREAM from llm_client
+    llm_client.STREAM = args.stream
+    print(f"Stream flag set to: {llm_client.STREAM}", file=sys.stderr)
+
+    # Set SPECULATIVE from chatbot
+    chatbot.SPECULATIVE = args.speculative
+    print(f"Speculative flag set to: {chatbot.SPECULATIVE}", file=sys.stderr)
+
+    # Set CACHE_ENABLED from prompt_cache
+    prompt_cache.CACHE_ENABLED = not args.no_cache
+    print(f"Prompt cache enabled: {prompt_cache.CACHE_ENABLED}", file=sys.stderr)
+
+    # Set context settings from context_window
+    context_window.CONTEXT_TOKEN_BUDGET = args.context_tokens
+    context_window.SUMMARIZE = args.summarize
+    print(f"Context token budget set to: {context_window.CONTEXT_TOKEN_BUDGET}, summarize: {context_window.SUMMARIZE}", file=sys.stderr)
+
     # Set MODEL_NAME from llm_client
     llm_client.MODEL_NAME = args.model
     print(f"Model set to: {llm_client.MODEL_NAME}", file=sys.stderr)
@@ -103,36 +275,256 @@ def process_args(args):
         print(f"Sleeping for {args.delay_seconds} seconds before initialization", file=sys.stderr)
         time.sleep(args.delay_seconds)
 
+    # Set RATE_LIMITS from llm_scheduler
+    llm_scheduler.RATE_LIMITS.update(args.rate_limit)
+    for name, limits in args.rate_limit:
+        print(f"Rate limit of {name}: {limits['requests_per_minute']} requests, {limits['tokens_per_minute']} tokens per minute", file=sys.stderr)
+
+    # Set DELIVERY from message_monitor
+    message_monitor.DELIVERY = args.delivery
+    message_monitor.POLL_MAX_INTERVAL_S = args.max_poll_interval
+    print(f"Message delivery set to: {message_monitor.DELIVERY}, max poll interval: {message_monitor.POLL_MAX_INTERVAL_S}s", file=sys.stderr)
+
+    # Set TRACE_SAMPLE_RATE from tracing
+    tracing.TRACE_SAMPLE_RATE = args.trace_sample
+    if args.trace_file is None:
+        args.trace_file = f"output/traces/{args.experiment_description}.json"
+    if args.checkpoint_file is None:
+        args.checkpoint_file = checkpoint.get_checkpoint_file(args.experiment_description)
+
+    # Shards write their own traces and metrics, the supervisor serves and aggregates the metrics
+    if args.shard is not None:
+        print(f"Running shard {args.shard} with rooms {args.rooms}", file=sys.stderr)
+        args.trace_file = supervisor.get_shard_file(args.trace_file, args.shard)
+        args.checkpoint_file = supervisor.get_shard_file(args.checkpoint_file, args.shard)
+        if supervisor.collects_metrics(args):
+            args.metrics_file = supervisor.get_shard_metrics_file(args.shard)
+        args.metrics_port = None
+    print(f"Checkpointing the bots to {args.checkpoint_file} every {args.checkpoint_interval}s", file=sys.stderr)
+    if tracing.TRACE_SAMPLE_RATE > 0:
+        print(f"Tracing {tracing.TRACE_SAMPLE_RATE:.0%} of messages and replies to {args.trace_file}", file=sys.stderr)
+
     # Print max_time_to_response
     utils.MAX_RESPONSE_DURATION_S = args.max_time_to_response
     print(f"Max time to response set to: {utils.MAX_RESPONSE_DURATION_S} seconds", file=sys.stderr)
 
-# Parse and process args
+# Parse args
 args = parse_args()
-process_args(args)
 
 # Read experiment description
-with open(get_experiment_description_file(args.experiment_description), 'r') as file:
-    bot_data = list(csv.DictReader(file))
+def read_bot_data():
+    with open(get_experiment_description_file(args.experiment_description), 'r') as file:
+        return list(csv.DictReader(file))
+
+def get_enabled_bots(bot_data):
+    # Ignore disabled bots, and bots of other rooms if --rooms is given
+    room_ids = args.rooms.split(',') if args.rooms else None
+    return [bot_desc for bot_desc in bot_data
+            if bot_desc["enable"] == "true" and (room_ids is None or bot_desc["chatroom"] in room_ids)]
+
+# In sharded mode, this process only supervises the processes running the bots
+if args.shards > 1 and args.shard is None:
+    supervisor.run(args, sys.argv, get_enabled_bots(read_bot_data()))
+    sys.exit(0)
+
+process_args(args)
+
+def get_bot_name(bot_desc):
+    return f'{bot_desc["chatroom"]}_{bot_desc["role"]}_{bot_desc["username"]}'
+
+# Bots of the experiment description by name, with their row and start task (running or done)
+active_bots: dict[str, tuple[dict, asyncio.Task]] = {}
+# Started bots by name, checkpointed periodically
+running_bots: dict[str, chatbot.LLMBot] = {}
+# Message monitoring task of every room with bots
+monitor_tasks: dict[str, asyncio.Task] = {}
+# Checkpoints of the bots resumed with --resume
+checkpoints: dict[str, dict] = {}
+
+startup_semaphore: asyncio.Semaphore | None = None
+reload_lock: asyncio.Lock | None = None
+# Reloads requested by SIGHUP, referenced until they are done
+reload_tasks: set[asyncio.Task] = set()
+
+def report_monitor_crash(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Message monitor crashed: {task.exception()!r}", file=sys.stderr)
+
+def start_room_monitor(room_id):
+    """
+    Start polling the room, unless its monitor (shared by all bots in the room) is already running.
+    """
+    if room_id not in monitor_tasks:
+        monitor_tasks[room_id] = asyncio.create_task(message_monitor.get_room_monitor(room_id).start_monitoring())
+        monitor_tasks[room_id].add_done_callback(report_monitor_crash)
+
+async def stop_room_monitor(room_id):
+    task = monitor_tasks.pop(room_id)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    del message_monitor.room_monitors[room_id]
+
+async def start_bot(bot_desc):
+    """
+    Construct and start a bot, then subscribe it to its room.
+    Returns the startup duration, or None if the bot failed to start (other bots are not affected).
+    """
+    async with startup_semaphore:
+        start_time = time.time()
+        try:
+            # Construct bot, its prompt files are read off the event loop when it starts
+            bot = chatbot.LLMBot(bot_desc)
+
+            # Start bot, it only receives messages once it is ready
+            await bot.start_bot(checkpoints.pop(get_bot_name(bot_desc), None))
+        except Exception as err:
+            print(f"Bot {get_bot_name(bot_desc)} failed to start after {time.time() - start_time:.3f}s: {err=}, {type(err)=}", file=sys.stderr)
+            return None
+        duration = time.time() - start_time
+
+    # Subscribe the bot to its room monitor (shared by all bots in the room)
+    message_monitor.get_room_monitor(bot_desc['chatroom']).subscribe(bot)
+    start_room_monitor(bot_desc['chatroom'])
+    running_bots[get_bot_name(bot_desc)] = bot
+    print(f"Bot {get_bot_name(bot_desc)} started in {duration:.3f}s", file=sys.stderr)
+    return duration
+
+def add_bot(bot_desc):
+    # The bot may modify its description, keep the row as read to compare it on reload
+    active_bots[get_bot_name(bot_desc)] = (bot_desc, asyncio.create_task(start_bot(dict(bot_desc))))
+
+async def stop_bot(name):
+    """
+    Stop a bot (starting or started), and the monitor of its room if it was the last bot there.
+    """
+    bot_desc, task = active_bots.pop(name)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    checkpoints.pop(name, None)
+    bot = running_bots.pop(name, None)
+    if bot is None:
+        return
+    monitor = message_monitor.room_monitors[bot_desc['chatroom']]
+    await monitor.unsubscribe(bot)
+    await bot.stop_bot()
+    if not monitor.subscriptions:
+        await stop_room_monitor(bot_desc['chatroom'])
+    print(f"Bot {name} stopped", file=sys.stderr)
+
+async def start_bots(bot_descs):
+    start_time = time.time()
+    for bot_desc in bot_descs:
+        add_bot(bot_desc)
+    durations = await asyncio.gather(*(active_bots[get_bot_name(bot_desc)][1] for bot_desc in bot_descs), return_exceptions=True)
+    durations = [duration if isinstance(duration, float) else None for duration in durations]
+
+    # Report startup durations, slowest first
+    started = sorted(((duration, get_bot_name(bot_desc)) for bot_desc, duration in zip(bot_descs, durations)
+                      if duration is not None), reverse=True)
+    print(f"Started {len(started)}/{len(bot_descs)} bots in {time.time() - start_time:.3f}s", file=sys.stderr)
+    for duration, name in started:
+        print(f"  {name}: {duration:.3f}s", file=sys.stderr)
+
+async def reload_experiment():
+    """
+    Diff the experiment description against the running bots, starting the new and changed rows
+    and stopping the removed, disabled and changed ones. The other bots are not touched.
+    """
+    async with reload_lock:
+        start_time = time.time()
+        try:
+            bot_descs = {get_bot_name(bot_desc): bot_desc for bot_desc in get_enabled_bots(read_bot_data())}
+        except (OSError, csv.Error, KeyError) as err:
+            print(f"Could not reload {get_experiment_description_file(args.experiment_description)}: {err=}", file=sys.stderr)
+            return
+        stopped = [name for name, (bot_desc, _) in active_bots.items() if bot_descs.get(name) != bot_desc]
+        for name in stopped:
+            await stop_bot(name)
+        started = [name for name in bot_descs if name not in active_bots]
+        for name in started:
+            add_bot(bot_descs[name])
+        print(f"Reloaded experiment description in {time.time() - start_time:.3f}s: "
+              f"stopped {len(stopped)}, starting {len(started)}, unchanged {len(active_bots) - len(started)} bots", file=sys.stderr)
+
+def request_reload():
+    task = asyncio.create_task(reload_experiment())
+    reload_tasks.add(task)
+    task.add_done_callback(reload_tasks.discard)
+
+async def watch_experiment(interval_s):
+    """
+    Reload the experiment description whenever its file changes.
+    """
+    filename = get_experiment_description_file(args.experiment_description)
+    modified = os.stat(filename).st_mtime_ns
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            new_modified = os.stat(filename).st_mtime_ns
+        except OSError:
+            continue    # Being replaced
+        if new_modified != modified:
+            modified = new_modified
+            await reload_experiment()
 
 async def run_bots_with_monitor():
-    tasks = []
-    for bot_desc in bot_data:
-        # Ignore disabled bots
-        if bot_desc["enable"] != "true":
-            continue
+    global startup_semaphore, reload_lock
+    startup_semaphore = asyncio.Semaphore(args.startup_parallelism)
+    reload_lock = asyncio.Lock()
+
+    loop = asyncio.get_running_loop()
+    # Stopping the process from the frontend sends SIGTERM, shut down cleanly so traces and metrics are written
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    # SIGHUP reloads the experiment description
+    loop.add_signal_handler(signal.SIGHUP, request_reload)
+
+    bot_descs = get_enabled_bots(read_bot_data())
+
+    if args.resume:
+        bot_names = {get_bot_name(bot_desc) for bot_desc in bot_descs}
+        checkpoints.update((name, state) for name, state in checkpoint.read_checkpoints(args.checkpoint_file).items()
+                           if name in bot_names)
+        print(f"Resuming {len(checkpoints)}/{len(bot_descs)} bots from {args.checkpoint_file}", file=sys.stderr)
+
+    # Start polling every room (one monitor per room), then all bots concurrently
+    for bot_desc in bot_descs:
+        start_room_monitor(bot_desc['chatroom'])
+    tasks = [asyncio.create_task(start_bots(bot_descs))]
 
-        # Construct bot
-        bot = chatbot.LLMBot(bot_desc)
+    # Checkpoints of the bots still starting are kept until they replace them
+    tasks.append(asyncio.create_task(
+        checkpoint.write_checkpoints_periodically(args.checkpoint_file, running_bots, args.checkpoint_interval, checkpoints)))
 
-        # Create start bot task
-        tasks.append(asyncio.create_task(bot.start_bot()))
+    if args.watch:
+        print(f"Watching {get_experiment_description_file(args.experiment_description)} for changes", file=sys.stderr)
+        tasks.append(asyncio.create_task(watch_experiment(args.watch_interval)))
 
-        # Create message monitoring task
-        monitor = MessageMonitor(f"http://localhost:3000/api/messages?roomId={bot_desc['chatroom']}", bot)
-        tasks.append(asyncio.create_task(monitor.start_monitoring()))
+    # Expose the metrics
+    metrics_runner = None
+    if args.metrics_port is not None:
+        metrics_runner = await metrics.start_server(port=args.metrics_port)
+        print(f"Serving metrics at http://localhost:{args.metrics_port}/metrics", file=sys.stderr)
+    if args.metrics_file is not None:
+        tasks.append(asyncio.create_task(metrics.write_snapshots(args.metrics_file, args.metrics_interval)))
 
-    await asyncio.gather(*tasks)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        tasks.extend(task for _, task in active_bots.values())
+        tasks.extend(monitor_tasks.values())
+        tasks.extend(reload_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await api.close()
+        if tracing.TRACE_SAMPLE_RATE > 0:
+            traces = tracing.export(args.trace_file)
+            print(f"Wrote {traces} traces to {args.trace_file}", file=sys.stderr)
 
 # Run the bots with the message monitor
-asyncio.run(run_bots_with_monitor())
+try:
+    asyncio.run(run_bots_with_monitor())
+except (asyncio.CancelledError, KeyboardInterrupt):
+    print("Bots stopped", file=sys.stderr)
@@ -1,64 +1,208 @@
 # message_monitor.py
-import aiohttp
-import time
-from datetime import datetime, timezone
+import asyncio
 import sys
+from datetime import datetime, timezone
+import aiohttp
+import api
+import clock
+import message_record
+import metrics
+import tracing
 import utils
 
-def parse_timestamp(timestamp):
-    # Check if the timestamp ends with 'Z' (indicating UTC)
-    if timestamp.endswith('Z'):
-        # Replace 'Z' with '+00:00'
-        timestamp = timestamp[:-1] + '+00:00'
-    
-    # Use fromisoformat to parse the modified timestamp
-    return datetime.fromisoformat(timestamp)
+# How the monitors receive the new messages of their room:
+# - "auto": long-poll (the server holds the request until there is a new message), falling back to
+#   adaptive polling while the server does not support it (every request still asks for long-poll,
+#   servers that do not support it answer right away)
+# - "poll": adaptive polling only
+DELIVERY = "auto"
+DELIVERIES = ["auto", "poll"]
+LONG_POLL_WAIT_S = 20       # Time the server holds a long-poll request (in real seconds)
+# Adaptive polling (in simulated seconds): poll fast while the room is active, and back off
+# exponentially while it is idle or the server fails. Long-polls also start at most every
+# POLL_MIN_INTERVAL_S, so bots replying to each other cannot make the monitor spin.
+POLL_MIN_INTERVAL_S = 1
+POLL_MAX_INTERVAL_S = 12
+POLL_BACKOFF_FACTOR = 2
 
-class MessageMonitor:
-    def __init__(self, api_url, bot):
-        self.api_url = api_url
+parse_timestamp = message_record.parse_timestamp
+
+class Subscription:
+    """
+    Delivers the new messages of a MessageMonitor to one bot.
+    Messages received while the bot is busy are accumulated and delivered together, so a bot
+    busy replying never delays the polling of the room or the delivery to the other bots.
+    Speculative bots (see ChatBot.speculate) get the messages received while they are reading at
+    once instead, so they read them as part of the same reply.
+    """
+    def __init__(self, bot):
         self.bot = bot
+        self.pending_messages = []
+        self.reset = False
+        self.has_update = asyncio.Event()
+        self.task = None
+
+    def push(self, messages, reset=False):
+        if (not reset and not self.pending_messages and getattr(self.bot, "speculative", False)
+                and self.bot.messages.ingest_while_reading(messages)):
+            return
+        if reset:
+            self.pending_messages = list(messages)
+            self.reset = True
+        else:
+            self.pending_messages.extend(messages)
+        self.has_update.set()
+
+    async def run(self):
+        while True:
+            await self.has_update.wait()
+            self.has_update.clear()
+            messages, reset = self.pending_messages, self.reset
+            self.pending_messages, self.reset = [], False
+            await self.bot.update_messages(messages, reset)
+
+class MessageMonitor:
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.subscriptions: list[Subscription] = []
         self.last_message_timestamp = datetime.min.replace(tzinfo=timezone.utc)
+        self.running = False
+        self.logger = utils.get_logger(f'{room_id}_monitor')
+
+        # Full history of the room (MessageRecords), kept once for all bots so late subscribers can catch up
+        self.messages = []
+        self.cursor = 0
+        self.generation = None
 
-    async def fetch_messages(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.api_url) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    print(f"Error fetching messages: {response.status}", file=sys.stderr)
-                    return []
-
-    def check_new_messages(self, messages):
-        new_messages = [
-            msg for msg in messages
-            if parse_timestamp(msg['timestamp']) > self.last_message_timestamp
-        ]
-        print("NEW MESSAGES!", new_messages)
-
-    async def update_message_list(self, messages):
-        if messages:
-            self.last_message_timestamp = max(
-                parse_timestamp(msg['timestamp']) for msg in messages
-            )
-
-        # Alert bot
-        await self.bot.update_messages(messages)
+        self.long_poll = None   # Whether the server supports long-poll, None until known
+        self.poll_interval = POLL_MIN_INTERVAL_S
+
+    def subscribe(self, bot):
+        subscription = Subscription(bot)
+        subscription.push(self.messages, reset=True)
+        self.subscriptions.append(subscription)
+        if self.running:
+            subscription.task = asyncio.create_task(subscription.run())
+
+    async def unsubscribe(self, bot):
+        """
+        Stop delivering messages to the bot, cancelling the update it may be processing.
+        """
+        for subscription in [subscription for subscription in self.subscriptions if subscription.bot is bot]:
+            self.subscriptions.remove(subscription)
+            if subscription.task is not None:
+                subscription.task.cancel()
+                await asyncio.gather(subscription.task, return_exceptions=True)
+
+    async def fetch_messages(self, wait_s=None):
+        """
+        Fetch the messages received since the last call, waiting up to wait_s seconds for one (long-poll).
+        Returns them as MessageRecords along with whether the room history had to be fully resynced.
+        """
+        update = await api.get_new_messages(self.room_id, self.cursor, self.generation, wait_s)
+        if wait_s is not None and self.long_poll is not update["long_poll"]:
+            if update["long_poll"]:
+                if self.long_poll is False:
+                    print(f'[{self.room_id}] Server supports long-poll again', file=sys.stderr)
+            else:
+                print(f'[{self.room_id}] Server does not support long-poll, falling back to polling', file=sys.stderr)
+            self.long_poll = update["long_poll"]
+        # Parse the update before moving the cursor past it, so a failure fetches the messages again
+        new_messages, reset, cursor = message_record.from_json_list(update["messages"]), update["reset"], update["cursor"]
+        self.cursor = cursor
+        self.generation = update.get("generation")
+        metrics.POLL_PAYLOAD.observe(update.get("size", 0), room=self.room_id)
+        metrics.POLL_MESSAGES.inc(len(update["messages"]), room=self.room_id)
+        if reset:
+            metrics.POLL_RESETS.inc(room=self.room_id)
+        return new_messages, reset
+
+    def check_new_messages(self, new_messages):
+        if new_messages:
+            self.logger.debug("New messages: %s", new_messages)
+
+    async def update_message_list(self, new_messages, reset=False):
+        if reset:
+            self.messages = list(new_messages)
+            self.last_message_timestamp = datetime.min.replace(tzinfo=timezone.utc)
+        else:
+            self.messages.extend(new_messages)
+
+        timestamps = [msg.timestamp for msg in new_messages if msg.timestamp is not None]
+        if timestamps:
+            self.last_message_timestamp = max(timestamps)
+
+        # Alert bots, all of them share the same decoded messages
+        for subscription in self.subscriptions:
+            subscription.push(new_messages, reset)
+
+    def trace_messages(self, new_messages, poll_start_time, poll_end_time):
+        """
+        Trace sampled messages from their timestamp until the poll that received them.
+        """
+        lane = f'room {self.room_id}'
+        for msg in new_messages:
+            if msg.timestamp is None:
+                continue
+            trace = tracing.start_trace("message", lane, msg.timestamp.timestamp(), sender=msg.name)
+            if trace is not None:
+                # A long-poll may have started long before the message was sent
+                trace.add_span("poll", max(poll_start_time, trace.start_time), poll_end_time)
+                trace.finish(poll_end_time)
 
     def log_messages(self, new_messages):
         with open('logs/chat_history.txt', 'a') as f:
             for msg in new_messages:
-                log_entry = f"{msg['name']} ({msg['timestamp']}): {msg['content']}\n"
+                log_entry = f"{msg.name} ({msg.timestamp.isoformat() if msg.timestamp else ''}): {msg.content}\n"
                 f.write(log_entry)
 
-    async def start_monitoring(self, interval=3):
+    def get_poll_interval(self, new_messages, failed):
+        """
+        Next polling interval: the shortest one while the room is active, backing off while it is idle.
+        """
+        if new_messages and not failed:
+            self.poll_interval = POLL_MIN_INTERVAL_S
+        else:
+            self.poll_interval = min(self.poll_interval * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL_S)
+        return self.poll_interval
+
+    async def start_monitoring(self):
+        self.running = True
+        for subscription in self.subscriptions:
+            subscription.task = asyncio.create_task(subscription.run())
+
         while True:
-            starting_time = time.time()
-            messages = await self.fetch_messages()
-            self.check_new_messages(messages)
-            await self.update_message_list(messages)
-            end_time = time.time()
-            await utils.bot_sleep(interval)
-            total_time_after_sleep = time.time()
-            print(f'Message update (without sleep) lasted for {end_time - starting_time:.3f}s')
-            print(f'Message update (including sleep) lasted for {total_time_after_sleep - starting_time:.3f}s')
+            long_poll = DELIVERY == "auto"
+            starting_time = clock.now()
+            failed = False
+            try:
+                new_messages, reset = await self.fetch_messages(LONG_POLL_WAIT_S if long_poll else None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+                print(f'[{self.room_id}] Error fetching messages: {e!r}', file=sys.stderr)
+                new_messages, reset, failed = [], False, True
+            if tracing.TRACE_SAMPLE_RATE > 0 and not reset:
+                self.trace_messages(new_messages, starting_time, clock.now())
+            self.check_new_messages(new_messages)
+            await self.update_message_list(new_messages, reset)
+            end_time = clock.now()
+            mode = "long_poll" if long_poll and self.long_poll else "poll"
+            metrics.POLL_DURATION.observe(end_time - starting_time, room=self.room_id, mode=mode)
+            # A long-poll returns as soon as there is a new message, so the next one can start as soon as
+            # POLL_MIN_INTERVAL_S has passed since this one started
+            if mode == "poll" or failed:
+                await utils.bot_sleep(self.get_poll_interval(new_messages, failed))
+            else:
+                self.poll_interval = POLL_MIN_INTERVAL_S
+                remaining_s = POLL_MIN_INTERVAL_S - (end_time - starting_time) * utils.SPEED_UP_FACTOR
+                if remaining_s > 0:
+                    await utils.bot_sleep(remaining_s)
+            self.logger.debug("Message update lasted for %.3fs (%.3fs including sleep)",
+                              end_time - starting_time, clock.now() - starting_time)
+
+# Registry of room monitors, so that each room is only polled once per cycle
+room_monitors: dict[str, MessageMonitor] = {}
+
+def get_room_monitor(room_id) -> MessageMonitor:
+    if room_id not in room_monitors:
+        room_monitors[room_id] = MessageMonitor(room_id)
+    return room_monitors[room_id]
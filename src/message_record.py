@@ -0,0 +1,73 @@
+"""
+Compact record of a chat message, built once when a MessageMonitor first receives the message and
+shared by every bot of the room. The timestamp is parsed, the names are interned and the history
+entry sent to the LLM is formatted only once, instead of on every poll by every bot.
+"""
+import sys
+from datetime import datetime
+
+import context_window
+import utils
+
+def parse_timestamp(timestamp):
+    # Check if the timestamp ends with 'Z' (indicating UTC)
+    if timestamp.endswith('Z'):
+        # Replace 'Z' with '+00:00'
+        timestamp = timestamp[:-1] + '+00:00'
+
+    # Use fromisoformat to parse the modified timestamp
+    return datetime.fromisoformat(timestamp)
+
+class MessageRecord:
+    __slots__ = ('room_id', 'name', 'email', 'content', 'timestamp', 'prompt', 'tokens', '_user_entry', '_assistant_entry')
+
+    def __init__(self, room_id, name, email, content, timestamp=None):
+        self.room_id = sys.intern(room_id)
+        self.name = sys.intern(name)
+        self.email = sys.intern(email) if email is not None else None
+        self.content = content
+        self.timestamp = timestamp      # Parsed datetime, None if the message has none
+        self.prompt = f"Message from {self.name}: {content}"
+        self.tokens = context_window.count_tokens(self.prompt)
+        self._user_entry = None
+        self._assistant_entry = None
+
+    @classmethod
+    def from_json(cls, data):
+        timestamp = data.get('timestamp')
+        return cls(data['roomId'], data['name'], data.get('email'), data['content'],
+                   parse_timestamp(timestamp) if timestamp else None)
+
+    def to_json(self):
+        data = {"roomId": self.room_id, "name": self.name, "email": self.email, "content": self.content}
+        if self.timestamp is not None:
+            data["timestamp"] = self.timestamp.isoformat()
+        return data
+
+    def get_entry(self, own):
+        """
+        History entry of the message for the LLM, as 'assistant' for its author and 'user' for the others.
+        Entries are shared by every bot of the room, so they must not be modified.
+        """
+        if own:
+            if self._assistant_entry is None:
+                self._assistant_entry = utils.build_message('assistant', self.prompt, self.name)
+            return self._assistant_entry
+        if self._user_entry is None:
+            self._user_entry = utils.build_message('user', self.prompt, self.name)
+        return self._user_entry
+
+    def __repr__(self):
+        return f'MessageRecord({self.to_json()!r})'
+
+def from_json_list(messages):
+    """
+    MessageRecords of the messages, skipping (and reporting) the malformed ones so the others are not lost.
+    """
+    records = []
+    for msg in messages:
+        try:
+            records.append(MessageRecord.from_json(msg))
+        except (KeyError, TypeError, ValueError, AttributeError) as err:
+            print(f"Skipping malformed message {msg!r}: {err!r}", file=sys.stderr)
+    return records
@@ -0,0 +1,236 @@
+"""
+Process-wide metrics of the bots: counters, gauges and histograms with labels (bot, room, model...).
+They can be served live in the Prometheus text format (/metrics) and as JSON (/metrics.json) with
+--metrics_port, and/or written periodically as a JSON snapshot file with --metrics_file, so runs
+can be watched live and compared across experiments.
+
+Updating a metric only touches a dict in memory, so it is cheap enough for the hot paths.
+"""
+import asyncio
+import bisect
+import json
+import time
+
+from aiohttp import web
+
+import utils
+
+# Buckets (upper bounds) of the histograms
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+TOKENS_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768)
+
+SNAPSHOT_INTERVAL_S = 15
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.values = {}    # Label values tuple -> value
+
+    def get_key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def to_prometheus(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        for key, value in self.values.items():
+            lines.append(f'{self.name}{self.format_labels(key)} {value}')
+        return lines
+
+    def to_json(self):
+        return [dict(zip(self.label_names, key), value=value) for key, value in self.values.items()]
+
+    def merge_json(self, values):
+        """
+        Add the values of a JSON snapshot of the same metric (e.g. from another process).
+        """
+        for value in values:
+            key = self.get_key(value)
+            self.values[key] = self.values.get(key, 0) + value["value"]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.get_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        if key not in self.values:
+            # Counts per bucket (the last one is +Inf), sum
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+        counts_and_sum = self.values[key]
+        counts_and_sum[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts_and_sum[1] += value
+
+    def to_prometheus(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.format_labels(key, [("le", str(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {cumulative}')
+        return lines
+
+    def to_json(self):
+        return [dict(zip(self.label_names, key), count=sum(counts), sum=total,
+                     buckets=dict(zip(map(str, self.buckets + ('+Inf',)), counts)))
+                for key, (counts, total) in self.values.items()]
+
+    def merge_json(self, values):
+        for value in values:
+            key = self.get_key(value)
+            counts_and_sum = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0])
+            for i, count in enumerate(value["buckets"].values()):
+                counts_and_sum[0][i] += count
+            counts_and_sum[1] += value["sum"]
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric):
+        assert metric.name not in self.metrics, f"Metric {metric.name} already registered"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def copy_definitions(self):
+        """
+        Empty registry with the same metrics.
+        """
+        registry = Registry()
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                registry.register(Histogram(metric.name, metric.description, metric.label_names, metric.buckets))
+            else:
+                registry.register(type(metric)(metric.name, metric.description, metric.label_names))
+        return registry
+
+    def to_prometheus(self):
+        return '\n'.join(line for metric in self.metrics.values() for line in metric.to_prometheus()) + '\n'
+
+    def to_json(self):
+        return {
+            "time": time.time(),
+            "metrics": {name: {"type": metric.type, "description": metric.description, "values": metric.to_json()}
+                        for name, metric in self.metrics.items()},
+        }
+
+REGISTRY = Registry()
+
+# Polling
+POLL_DURATION = REGISTRY.histogram("poll_duration_seconds", "Duration of a poll (or long-poll) of the messages of a room", ["room", "mode"])
+POLL_PAYLOAD = REGISTRY.histogram("poll_payload_bytes", "Size of the response of a poll", ["room"], BYTES_BUCKETS)
+POLL_MESSAGES = REGISTRY.counter("poll_messages_total", "Messages received by the polls of a room", ["room"])
+POLL_RESETS = REGISTRY.counter("poll_resets_total", "Polls that had to resync the whole room history", ["room"])
+
+# LLM
+LLM_DURATION = REGISTRY.histogram("llm_request_duration_seconds", "Duration of the LLM requests of a bot", ["bot", "model"])
+LLM_ERRORS = REGISTRY.counter("llm_request_errors_total", "Failed LLM requests", ["bot", "model"])
+LLM_PROMPT_TOKENS = REGISTRY.histogram("llm_prompt_tokens", "Tokens of the prompts sent to the LLM", ["bot", "model"], TOKENS_BUCKETS)
+LLM_COMPLETION_TOKENS = REGISTRY.counter("llm_completion_tokens_total", "Tokens generated by the LLM", ["bot", "model"])
+
+# Conversation state machine
+STATE_DURATION = REGISTRY.counter("chat_state_seconds_total", "Time spent by a bot in each ChatState", ["bot", "room", "state"])
+ABORTS = REGISTRY.counter("reply_aborts_total", "Replies aborted by the bots, by reason", ["bot", "room", "reason"])
+REPLIES = REGISTRY.counter("replies_total", "Messages sent by the bots", ["bot", "room"])
+SPECULATIONS = REGISTRY.counter("speculative_replies_total", "Replies generated while reading, by outcome (used or discarded)", ["bot", "room", "outcome"])
+REPLY_LATENCY = REGISTRY.histogram("reply_latency_seconds", "Time from a bot starting to read new messages to its reply being sent", ["bot", "room"])
+
+def to_prometheus():
+    return REGISTRY.to_prometheus()
+
+def to_json():
+    return REGISTRY.to_json()
+
+def merge_snapshots(snapshots):
+    """
+    Registry adding up the JSON snapshots of several processes (e.g. the shards of main.py).
+    """
+    registry = REGISTRY.copy_definitions()
+    for snapshot in snapshots:
+        for name, metric in snapshot["metrics"].items():
+            if name in registry.metrics:
+                registry.metrics[name].merge_json(metric["values"])
+    return registry
+
+def read_snapshot(filename):
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+async def handle_prometheus(request):
+    registry = request.app["get_registry"]()
+    return web.Response(text=registry.to_prometheus(), content_type="text/plain", charset="utf-8")
+
+async def handle_json(request):
+    return web.json_response(request.app["get_registry"]().to_json())
+
+async def start_server(host="localhost", port=9100, get_registry=lambda: REGISTRY):
+    """
+    Serve the metrics at /metrics (Prometheus text) and /metrics.json. Returns the runner.
+    get_registry returns the registry to serve, by default the one of this process.
+    """
+    app = web.Application()
+    app["get_registry"] = get_registry
+    app.router.add_get("/metrics", handle_prometheus)
+    app.router.add_get("/metrics.json", handle_json)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def write_snapshot(filename, snapshot):
+    utils.write_json_atomic(filename, snapshot)
+
+async def write_snapshots(filename, interval_s=SNAPSHOT_INTERVAL_S):
+    """
+    Write a JSON snapshot of the metrics every interval_s seconds, and a last one when cancelled.
+    """
+    try:
+        while True:
+            await asyncio.to_thread(write_snapshot, filename, to_json())
+            await asyncio.sleep(interval_s)
+    finally:
+        write_snapshot(filename, to_json())
@@ -0,0 +1,100 @@
+"""
+Persistent on-disk cache of the startup completions of the bots (self-reflections and greetings).
+Entries are keyed by a hash of the model, the prompt files and the messages sent, so any change to
+`assets/bot-descriptions/*` invalidates them.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+import utils
+
+CACHE_ENABLED = True                    # --no_cache disables it
+CACHE_DIRECTORY = 'output/cache'
+CACHE_TTL_S = 30 * 24 * 60 * 60         # Entries older than this are discarded
+CACHE_MAX_ENTRIES = 1000                # The oldest entries are evicted above this size
+ELABORATED_PROMPTS_DIRECTORY = 'output/elaborated_prompts'
+
+def is_enabled():
+    # Offline responses are fake, never mix them with real ones
+    return CACHE_ENABLED and not utils.OFFLINE
+
+def get_key(model, prompt_texts, messages):
+    data = json.dumps([model, list(prompt_texts), list(messages)], ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def get_path(key):
+    return os.path.join(CACHE_DIRECTORY, f'{key}.json')
+
+def get(key):
+    """
+    Return the cached response for the key, or None if missing or expired.
+    """
+    if not is_enabled():
+        return None
+    path = get_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL_S:
+            os.remove(path)
+            return None
+        with open(path, 'r') as file:
+            return json.load(file)['response']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def put(key, response):
+    if not is_enabled() or response is None:
+        return
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+
+    # Write atomically, so concurrent bots never read a partial entry (bots write from threads)
+    path = get_path(key)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'response': response}, file)
+    os.replace(tmp_path, path)
+
+    evict()
+
+def evict():
+    """
+    Remove expired entries, then the oldest ones until the cache fits CACHE_MAX_ENTRIES.
+    """
+    entries = []
+    for path in glob.glob(os.path.join(CACHE_DIRECTORY, '*.json')):
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    entries.sort()
+
+    now = time.time()
+    excess = len(entries) - CACHE_MAX_ENTRIES
+    for i, (mtime, path) in enumerate(entries):
+        if i >= excess and now - mtime <= CACHE_TTL_S:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def find_elaborated_prompt(model, prefix, suffix):
+    """
+    Look for a previously written elaborated prompt of the model made of the same prompt files,
+    i.e. starting with prefix and ending with suffix. Returns the text in between (the
+    self-reflection) of the most recent one, or None.
+    """
+    if not is_enabled():
+        return None
+    # File names start with a timestamp, so sorting them puts the most recent first
+    for path in sorted(glob.glob(os.path.join(ELABORATED_PROMPTS_DIRECTORY, f'*-{model}.txt')), reverse=True):
+        try:
+            text = utils.read_file_text(path)
+        except OSError:
+            continue
+        if len(text) > len(prefix) + len(suffix) and text.startswith(prefix) and text.endswith(suffix):
+            return text[len(prefix):len(text) - len(suffix)]
+    return None
@@ -1,48 +1,128 @@
+import asyncio
 import csv
 import time
 import argparse
 import os
+import sys
 from datetime import datetime
 import api
+import utils
+
+MAX_IN_FLIGHT = 100  # Maximum number of messages being sent at the same time
+MAX_PENDING = 1000   # Maximum number of messages due but not sent yet, reading of the file waits above it
 
 def read_csv(filename):
-    """Reads the CSV file and returns a list of messages sorted by timestamp."""
-    with open(filename, mode="r", encoding="utf-8") as file:
-        return [{
-            "roomId": row["roomId"],
-            "name": row["name"],
-            "email": row["email"],
-            "content": row["content"],
-            "timestamp": datetime.strptime(row["timestamp"], "%d/%m/%Y %H:%M:%S"),
-        } for row in csv.DictReader(file)]
-
-def process_messages(messages, speedup_factor):
-    """Sends messages in order while respecting timestamps, adjusted by speedup_factor."""
-    if not messages:
-        print("No messages to send.")
-        return
-    
-    KEYS = ["roomId", "name", "email", "content"]
+    """
+    Reads the CSV file lazily, yielding its messages one by one.
+    Rows are expected in timestamp order, as in the recorded output/conversations files.
+    """
+    with open(filename, mode="r", encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file):
+            yield {
+                "roomId": row["roomId"],
+                "name": row["name"],
+                "email": row["email"],
+                "content": row["content"],
+                "timestamp": datetime.strptime(row["timestamp"], "%d/%m/%Y %H:%M:%S"),
+            }
+
+class Replayer:
+    """
+    Sends every message at an absolute deadline (start time + its offset in the recording / speedup),
+    so waiting for a slow POST never delays the later messages. Messages of the same room are still
+    posted in order, as the server timestamps them on arrival. When sending falls behind, at most
+    max_pending send tasks are created ahead of the messages being sent.
+    """
+    def __init__(self, speedup_factor, room_id=None, max_in_flight=MAX_IN_FLIGHT, lateness_writer=None, max_pending=MAX_PENDING):
+        self.speedup_factor = speedup_factor
+        self.room_id = room_id
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.lateness_writer = lateness_writer
+        self.last_sends = {}    # Last send task of each room
+        self.latenesses = []
+        self.failed = 0
+
+    async def send(self, message, message_time, previous_send):
+        if previous_send is not None:
+            await asyncio.wait([previous_send])
+        async with self.in_flight:
+            lateness = asyncio.get_running_loop().time() - message_time
+            try:
+                await api.send_message({
+                    "roomId": message["roomId"],
+                    "name": message["name"],
+                    "email": message["email"],
+                    "content": message["content"],
+                })
+                status = "sent"
+            except Exception as err:
+                print(f"Error sending message from {message['name']} to {message['roomId']}: {err=}", file=sys.stderr)
+                self.failed += 1
+                status = "failed"
+
+        self.latenesses.append(lateness)
+        if self.lateness_writer:
+            self.lateness_writer.writerow([message["roomId"], message["name"], message["timestamp"].isoformat(), f"{lateness:.6f}", status])
+
+    async def replay(self, messages):
+        """Sends messages while respecting timestamps, adjusted by speedup_factor."""
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()  # Reference point for every deadline, monotonic
+        base_timestamp = None     # Reference timestamp
 
-    start_time = time.time()  # Reference point for waiting
-    base_timestamp = messages[0]["timestamp"]  # Reference timestamp
+        for message in messages:
+            if self.room_id is not None:
+                message["roomId"] = self.room_id
+            if base_timestamp is None:
+                base_timestamp = message["timestamp"]
+            time_offset = (message["timestamp"] - base_timestamp).total_seconds() / self.speedup_factor
+            message_time = start_time + time_offset
 
-    for message in messages:
-        time_offset = (message["timestamp"] - base_timestamp).total_seconds() / speedup_factor
-        message_time = start_time + time_offset
+            await asyncio.sleep(max(0, message_time - loop.time()))
+            await self.pending.acquire()
+            room_id = message["roomId"]
+            task = asyncio.create_task(self.send(message, message_time, self.last_sends.get(room_id)))
+            task.add_done_callback(lambda _: self.pending.release())
+            self.last_sends[room_id] = task
 
-        time.sleep(max(0, message_time - time.time()))
-        api.send_message({
-            "roomId" : "test",
-            "name": message["name"],
-            "email": message["email"],
-            "content": message["content"],
-        })
+        if self.last_sends:
+            await asyncio.wait(self.last_sends.values())
+
+    def report(self):
+        return {
+            "messages": len(self.latenesses),
+            "failed": self.failed,
+            "lateness_s": utils.summarize(self.latenesses),
+        }
+
+async def replay(file_path, speedup_factor, room_id=None, max_in_flight=MAX_IN_FLIGHT, lateness_path=None, max_pending=MAX_PENDING):
+    lateness_file = open(lateness_path, "w", newline="") if lateness_path else None
+    try:
+        lateness_writer = None
+        if lateness_file:
+            lateness_writer = csv.writer(lateness_file)
+            lateness_writer.writerow(["roomId", "name", "timestamp", "lateness_s", "status"])
+        replayer = Replayer(speedup_factor, room_id, max_in_flight, lateness_writer, max_pending)
+
+        start_time = time.time()
+        await replayer.replay(read_csv(file_path))
+        report = replayer.report()
+        report["duration_s"] = time.time() - start_time
+        return report
+    finally:
+        if lateness_file:
+            lateness_file.close()
+        await api.close()
 
 def main():
     parser = argparse.ArgumentParser(description="Process a CSV file and send messages with timing.")
     parser.add_argument("file_path", help="Path to the CSV file")
     parser.add_argument("--speedup", type=float, default=1.0, help="Speedup factor (default: 1.0)")
+    parser.add_argument("--room", help="Send every message to this room instead of the roomId of each row")
+    parser.add_argument("--max_in_flight", type=int, default=MAX_IN_FLIGHT, help=f"Maximum messages being sent at the same time (default: {MAX_IN_FLIGHT})")
+    parser.add_argument("--max_pending", type=int, default=MAX_PENDING, help=f"Maximum messages due but not sent yet (default: {MAX_PENDING})")
+    parser.add_argument("--lateness_csv", help="Write how late each message was sent to this CSV file")
 
     args = parser.parse_args()
 
@@ -55,8 +135,15 @@ def main():
         print(f"Error: File '{args.file_path}' not found.")
         return
 
-    messages = read_csv(args.file_path)
-    process_messages(messages, args.speedup)
+    report = asyncio.run(replay(args.file_path, args.speedup, args.room, args.max_in_flight, args.lateness_csv, args.max_pending))
+    if not report["messages"]:
+        print("No messages to send.")
+        return
+
+    lateness = report["lateness_s"]
+    print(f"Sent {report['messages'] - report['failed']}/{report['messages']} messages in {report['duration_s']:.2f}s")
+    print(f"Lateness: mean {lateness['mean']*1000:.1f}ms, p50 {lateness['p50']*1000:.1f}ms, "
+          f"p99 {lateness['p99']*1000:.1f}ms, max {lateness['max']*1000:.1f}ms")
 
 if __name__ == "__main__":
     main()
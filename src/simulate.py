@@ -0,0 +1,202 @@
+"""
+Discrete-event simulation of the conversation state machine (ChatHistoryInteractionManager).
+Each simulated conversation has a seeded stream of human messages, a room poller and a bot whose
+LLM calls take a seeded amount of time. The state transitions of every bot are recorded, in
+simulated seconds, so timing behaviour can be checked without waiting in real time.
+
+By default it runs on a virtual clock (clock.run_virtual), thousands of conversations in seconds.
+--real runs the same simulation in scaled real time, on the wall clock and the default event loop as
+the bots do, and --compare runs both and reports how far the real-time run diverged. The bots sleep
+for relative delays, so in real time every wake-up is a little late and the lateness adds up: a
+reply landing within that lateness of a poll is then delivered one poll later, and the rest of that
+conversation differs (mismatch_rate).
+
+Usage: python3 src/simulate.py --conversations 1000 --messages 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+
+import clock
+import conversation_manager
+import message_monitor
+import message_record
+import utils
+
+BOT_NAME = "SimBot"
+POLL_INTERVAL_S = 3
+
+class RecordingManager(conversation_manager.ChatHistoryInteractionManager):
+    """
+    Records every state transition with its time in simulated seconds since start_time.
+    """
+    def __init__(self, start_time, *args):
+        super().__init__(*args)
+        self.start_time = start_time
+        self.transitions = []
+
+    def update_state(self, new_state, aborted=False):
+        elapsed_s = (clock.now() - self.start_time) * utils.SPEED_UP_FACTOR
+        self.transitions.append((round(elapsed_s, 3), new_state.name))
+        super().update_state(new_state, aborted)
+
+class SimulatedRoom:
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.messages = []
+
+    def post(self, name, content):
+        self.messages.append(message_record.MessageRecord(self.room_id, name, f"{name}@sim.sim", content))
+
+class SimulatedBot:
+    """
+    Mimics ChatBot.update_messages, with an LLM call taking a seeded amount of simulated time.
+    """
+    def __init__(self, room, manager, rng, llm_latency_s):
+        self.room = room
+        self.messages = manager
+        self.rng = rng
+        self.llm_latency_s = llm_latency_s
+        self.replies = 0
+
+    async def update_messages(self, messages, reset=False):
+        write_afterwards = await self.messages.update_messages(messages, reset)
+        if not write_afterwards:
+            return
+        await utils.bot_sleep(self.rng.uniform(*self.llm_latency_s))
+        response = f"Reply number {self.replies} " + "blah " * self.rng.randint(5, 30)
+        self.replies += 1
+        await self.messages.write_message(response, False)
+        self.room.post(BOT_NAME, response)
+
+async def sleep_until(start_time, time_s):
+    """
+    Sleep until time_s simulated seconds after start_time.
+    """
+    await asyncio.sleep(max(0, start_time + time_s / utils.SPEED_UP_FACTOR - clock.now()))
+
+async def poll(room, subscription, start_time):
+    cursor = 0
+    polls = 0
+    while True:
+        new_messages = room.messages[cursor:]
+        cursor += len(new_messages)
+        subscription.push(new_messages)
+        polls += 1
+        await sleep_until(start_time, polls * POLL_INTERVAL_S)
+
+async def human(room, rng, messages_count, interval_s, start_time):
+    time_s = 0
+    for i in range(messages_count):
+        time_s += rng.uniform(*interval_s)
+        await sleep_until(start_time, time_s)
+        room.post(f"Human{rng.randint(0, 3)}", f"Human message {i} " + "words " * rng.randint(1, 40))
+
+async def simulate_conversation(seed, args, logger):
+    # Separate generators, so the draws do not depend on how the tasks interleave
+    human_rng = random.Random(f"human{seed}")
+    bot_rng = random.Random(f"bot{seed}")
+    room = SimulatedRoom(f"sim{seed}")
+    start_time = clock.now()
+    manager = RecordingManager(start_time, BOT_NAME, room.room_id, logger)
+    bot = SimulatedBot(room, manager, bot_rng, (args.llm_min_s, args.llm_max_s))
+    subscription = message_monitor.Subscription(bot)
+
+    tasks = [
+        asyncio.create_task(subscription.run()),
+        asyncio.create_task(poll(room, subscription, start_time)),
+    ]
+    await human(room, human_rng, args.messages, (args.interval_min_s, args.interval_max_s), start_time)
+
+    # Leave time for the last reply
+    await utils.bot_sleep(utils.MAX_RESPONSE_DURATION_S + 2 * POLL_INTERVAL_S)
+    for task in tasks:
+        task.cancel()
+    return {"seed": seed, "replies": bot.replies, "transitions": manager.transitions}
+
+async def simulate(args, seeds):
+    logger = logging.getLogger("simulate")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return await asyncio.gather(*(simulate_conversation(seed, args, logger) for seed in seeds))
+
+def run(args, seeds, virtual):
+    if virtual:
+        return clock.run_virtual(simulate(args, seeds))
+    clock.CLOCK = clock.RealClock()
+    return asyncio.run(simulate(args, seeds))
+
+def compare(virtual_results, real_results, tolerance_s):
+    """
+    Check both runs went through the same transitions, at the same simulated times within tolerance_s.
+    Deviations are measured on the transitions both runs share, up to the first one that differs.
+    """
+    deviations = []
+    mismatches = []
+    for virtual, real in zip(virtual_results, real_results):
+        for (virtual_time, virtual_state), (real_time, real_state) in zip(virtual["transitions"], real["transitions"]):
+            if virtual_state != real_state:
+                break
+            deviations.append(abs(virtual_time - real_time))
+        if [state for _, state in virtual["transitions"]] != [state for _, state in real["transitions"]]:
+            mismatches.append(virtual["seed"])
+    max_deviation_s = max(deviations, default=0)
+    return {
+        "conversations": len(virtual_results),
+        "mismatched_seeds": mismatches,
+        "mismatch_rate": len(mismatches) / len(virtual_results) if virtual_results else 0,
+        "deviation_s": utils.summarize(deviations),
+        "max_deviation_s": max_deviation_s,
+        "identical": not mismatches and max_deviation_s <= tolerance_s,
+    }
+
+def summarize(results):
+    time_in_state = {}
+    for result in results:
+        transitions = result["transitions"]
+        for (start_s, state), (end_s, _) in zip(transitions, transitions[1:]):
+            time_in_state[state] = time_in_state.get(state, 0) + end_s - start_s
+    return {
+        "conversations": len(results),
+        "replies": sum(result["replies"] for result in results),
+        "transitions": sum(len(result["transitions"]) for result in results),
+        "mean_time_in_state_s": {state: total / len(results) for state, total in time_in_state.items()},
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulate conversations of the bot state machine.")
+    parser.add_argument("--conversations", type=int, default=1000, help="Number of simulated conversations (default: 1000)")
+    parser.add_argument("--messages", type=int, default=20, help="Human messages per conversation (default: 20)")
+    parser.add_argument("--interval_min_s", type=float, default=2, help="Minimum seconds between human messages")
+    parser.add_argument("--interval_max_s", type=float, default=30, help="Maximum seconds between human messages")
+    parser.add_argument("--llm_min_s", type=float, default=0.5, help="Minimum simulated LLM latency")
+    parser.add_argument("--llm_max_s", type=float, default=5, help="Maximum simulated LLM latency")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Speed up factor, as in main.py (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first conversation (default: 0)")
+    parser.add_argument("--real", action="store_true", help="Run in scaled real time instead of virtual time")
+    parser.add_argument("--compare", action="store_true", help="Run both in virtual and scaled real time and compare")
+    parser.add_argument("--tolerance_s", type=float, default=0.5, help="Maximum deviation in simulated seconds for --compare")
+    parser.add_argument("--traces", action="store_true", help="Output the transitions of every conversation")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    utils.SPEED_UP_FACTOR = args.speedup
+    seeds = range(args.seed, args.seed + args.conversations)
+
+    if args.compare:
+        report = compare(run(args, seeds, True), run(args, seeds, False), args.tolerance_s)
+    else:
+        results = run(args, seeds, not args.real)
+        report = {"summary": summarize(results)}
+        if args.traces:
+            report["traces"] = results
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Local stand-in for the `/api/messages` route of the Next.js app (pages/api/messages.ts).
+Keeps messages in memory only, so it can be used to run and test the bots without the frontend.
+"""
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+
+MAX_WAIT_S = 30     # Longest a long-poll request is held
+
+class MessageStore:
+    def __init__(self):
+        self.rooms: dict[str, list] = {}
+        self.generation = str(time.time_ns())
+        self.waiters: dict[str, set[asyncio.Future]] = {}   # Long-poll requests waiting for each room
+
+    def wake_up(self, room_ids):
+        for room_id in room_ids:
+            for waiter in self.waiters.pop(room_id, ()):
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def add(self, message):
+        self.rooms.setdefault(message["roomId"], []).append(message)
+        self.wake_up([message["roomId"]])
+
+    def delete_all(self):
+        self.rooms = {}
+        self.generation = str(time.time_ns())
+        self.wake_up(list(self.waiters))
+
+    async def wait(self, room_id, since, generation=None, timeout_s=None):
+        """
+        Like get, but waits up to timeout_s seconds for a new message if there is none yet (long-poll).
+        """
+        update = self.get(room_id, since, generation)
+        if update["messages"] or update["reset"]:
+            return update
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(room_id, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout_s)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiters.get(room_id, set()).discard(waiter)
+        return self.get(room_id, since, generation)
+
+    def get(self, room_id, since=None, generation=None):
+        room = self.rooms.get(room_id, [])
+        if since is None:
+            return room
+        # If messages were deleted since the client's last fetch, it must resync everything
+        reset = since > len(room) or (generation is not None and generation != self.generation)
+        return {
+            "messages": room if reset else room[since:],
+            "cursor": len(room),
+            "generation": self.generation,
+            "reset": reset,
+        }
+
+async def handle_messages(request):
+    store: MessageStore = request.app["store"]
+    if request.method == "GET":
+        room_id = request.query.get("roomId")
+        if room_id is None:
+            return web.json_response({"error": "Invalid room ID"}, status=400)
+        since = request.query.get("since")
+        if since is not None:
+            if not since.isdigit():
+                return web.json_response({"error": "Invalid cursor"}, status=400)
+            since = int(since)
+        wait = request.query.get("wait")
+        if since is not None and wait is not None:
+            try:
+                wait_s = min(float(wait), MAX_WAIT_S)
+            except ValueError:
+                return web.json_response({"error": "Invalid wait"}, status=400)
+            update = await store.wait(room_id, since, request.query.get("generation"), wait_s)
+            return web.json_response(dict(update, longPoll=True))
+        return web.json_response(store.get(room_id, since, request.query.get("generation")))
+    elif request.method == "POST":
+        message = await request.json()
+        store.add(message)
+        return web.json_response(message, status=201)
+    elif request.method == "DELETE":
+        store.delete_all()
+        return web.json_response({"message": "All messages have been deleted."})
+    return web.Response(status=405)
+
+async def release_waiters(app):
+    # Answer the pending long-polls right away instead of holding the shutdown
+    store = app["store"]
+    store.wake_up(list(store.waiters))
+
+def build_app(store=None):
+    app = web.Application()
+    app["store"] = store if store is not None else MessageStore()
+    app.router.add_route("*", "/api/messages", handle_messages)
+    app.on_shutdown.append(release_waiters)
+    return app
+
+async def start_server(host="localhost", port=3000, store=None):
+    """
+    Start the stand-in server in the running event loop.
+    Returns the runner, call `await runner.cleanup()` to stop it.
+    """
+    runner = web.AppRunner(build_app(store))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an in-memory stand-in for /api/messages.")
+    parser.add_argument("--host", default="localhost", help="Host to listen on (default: localhost)")
+    parser.add_argument("--port", type=int, default=3000, help="Port to listen on (default: 3000)")
+    args = parser.parse_args()
+
+    web.run_app(build_app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Supervisor of the sharded mode of main.py (--shards N).
+The rooms of the experiment are partitioned across N worker processes, each one running main.py
+with only the bots of its rooms (--rooms), so every room is still polled by a single monitor and
+keeps one consistent view, while the CPU work of the bots is spread across cores.
+
+The supervisor restarts crashed workers (with backoff, resuming their bots from their checkpoints), forwards SIGTERM/SIGINT to them, prefixes
+and forwards their output, and aggregates their metrics (each worker writes a snapshot file that
+the supervisor merges and serves/writes as a single registry). SIGHUP is forwarded too, so the
+shards reload the experiment description for their rooms (rooms added later need a restart).
+"""
+import asyncio
+import os
+import signal
+import sys
+import time
+
+import metrics
+
+RESTART_DELAY_S = 1         # Delay before restarting a crashed worker, doubled on every crash
+MAX_RESTART_DELAY_S = 60
+STABLE_RUN_S = 60           # Workers running for this long get their restart delay reset
+SHUTDOWN_TIMEOUT_S = 30     # Time given to the workers to stop before killing them
+SHARD_METRICS_DIRECTORY = 'output/metrics/shards'
+
+def assign_rooms(bot_descs, shards):
+    """
+    Partition the rooms across shards, balancing the number of bots of each shard.
+    Returns a list with the rooms of each shard.
+    """
+    bots_per_room = {}
+    for bot_desc in bot_descs:
+        bots_per_room[bot_desc["chatroom"]] = bots_per_room.get(bot_desc["chatroom"], 0) + 1
+
+    # Largest rooms first, each one to the least loaded shard
+    shard_rooms = [[] for _ in range(shards)]
+    shard_bots = [0] * shards
+    for room_id, count in sorted(bots_per_room.items(), key=lambda item: (-item[1], item[0])):
+        shard = min(range(shards), key=lambda i: (shard_bots[i], i))
+        shard_rooms[shard].append(room_id)
+        shard_bots[shard] += count
+    return [rooms for rooms in shard_rooms if rooms]
+
+def collects_metrics(args):
+    return args.metrics_port is not None or args.metrics_file is not None
+
+def get_shard_metrics_file(shard):
+    return f'{SHARD_METRICS_DIRECTORY}/shard{shard}.json'
+
+def get_shard_file(filename, shard):
+    root, extension = os.path.splitext(filename)
+    return f'{root}.shard{shard}{extension}'
+
+class Worker:
+    def __init__(self, shard, rooms, argv):
+        self.shard = shard
+        self.rooms = rooms
+        self.argv = argv
+        self.process = None
+        self.restarts = 0
+
+    async def start(self):
+        # Restarted workers resume the conversations of their bots from their checkpoints
+        resume = ['--resume'] if self.restarts > 0 and '--resume' not in self.argv else []
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, *self.argv, *resume, '--shard', str(self.shard), '--rooms', ','.join(self.rooms),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        print(f"[supervisor] Started shard {self.shard} (pid {self.process.pid}) with rooms {','.join(self.rooms)}", file=sys.stderr)
+
+    def signal(self, signum):
+        if self.process is not None and self.process.returncode is None:
+            self.process.send_signal(signum)
+
+async def forward_output(stream, output, prefix):
+    while line := await stream.readline():
+        output.write(prefix + line.decode(errors='replace'))
+        output.flush()
+
+class Supervisor:
+    def __init__(self, args, argv, bot_descs):
+        self.args = args
+        self.workers = [Worker(shard, rooms, argv) for shard, rooms in enumerate(assign_rooms(bot_descs, args.shards))]
+        self.stopping = False
+
+    def stop(self, signum=None):
+        if signum is not None and not self.stopping:
+            print(f"[supervisor] Received {signal.Signals(signum).name}, stopping the shards", file=sys.stderr)
+        self.stopping = True
+        for worker in self.workers:
+            worker.signal(signal.SIGTERM)
+
+    async def supervise(self, worker):
+        """
+        Run the worker, restarting it whenever it crashes, until the supervisor stops.
+        """
+        restart_delay_s = RESTART_DELAY_S
+        while True:
+            start_time = time.monotonic()
+            await worker.start()
+            prefix = f'[shard {worker.shard}] '
+            await asyncio.gather(
+                forward_output(worker.process.stdout, sys.stdout, prefix),
+                forward_output(worker.process.stderr, sys.stderr, prefix),
+                worker.process.wait())
+
+            returncode = worker.process.returncode
+            if self.stopping or returncode == 0:
+                print(f"[supervisor] Shard {worker.shard} exited with code {returncode}", file=sys.stderr)
+                return
+            if time.monotonic() - start_time > STABLE_RUN_S:
+                restart_delay_s = RESTART_DELAY_S
+            print(f"[supervisor] Shard {worker.shard} crashed with code {returncode}, restarting in {restart_delay_s}s", file=sys.stderr)
+            await asyncio.sleep(restart_delay_s)
+            if self.stopping:
+                return
+            worker.restarts += 1
+            restart_delay_s = min(restart_delay_s * 2, MAX_RESTART_DELAY_S)
+
+    def reload(self):
+        # Every shard reloads the experiment description for its own rooms
+        print("[supervisor] Received SIGHUP, reloading the shards", file=sys.stderr)
+        for worker in self.workers:
+            worker.signal(signal.SIGHUP)
+
+    def get_registry(self):
+        """
+        Registry with the merged metrics of every shard.
+        """
+        snapshots = []
+        for worker in self.workers:
+            snapshot = metrics.read_snapshot(get_shard_metrics_file(worker.shard))
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        return metrics.merge_snapshots(snapshots)
+
+    async def write_metrics(self):
+        try:
+            while True:
+                await asyncio.sleep(self.args.metrics_interval)
+                await asyncio.to_thread(metrics.write_snapshot, self.args.metrics_file, self.get_registry().to_json())
+        finally:
+            metrics.write_snapshot(self.args.metrics_file, self.get_registry().to_json())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop, signum)
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+        print(f"[supervisor] Running {len(self.workers)} shards", file=sys.stderr)
+        # Do not merge the metrics of a previous run
+        for worker in self.workers:
+            if os.path.exists(get_shard_metrics_file(worker.shard)):
+                os.remove(get_shard_metrics_file(worker.shard))
+        metrics_runner = None
+        metrics_task = None
+        if self.args.metrics_port is not None:
+            metrics_runner = await metrics.start_server(port=self.args.metrics_port, get_registry=self.get_registry)
+            print(f"[supervisor] Serving metrics at http://localhost:{self.args.metrics_port}/metrics", file=sys.stderr)
+        if self.args.metrics_file is not None:
+            metrics_task = asyncio.create_task(self.write_metrics())
+
+        supervise_tasks = [asyncio.create_task(self.supervise(worker)) for worker in self.workers]
+        try:
+            await asyncio.wait(supervise_tasks)
+        finally:
+            # Give the workers time to stop, then kill them
+            self.stop()
+            _, pending = await asyncio.wait(supervise_tasks, timeout=SHUTDOWN_TIMEOUT_S)
+            for worker in self.workers:
+                worker.signal(signal.SIGKILL)
+            if pending:
+                await asyncio.wait(pending)
+            if metrics_task is not None:
+                metrics_task.cancel()
+                await asyncio.gather(metrics_task, return_exceptions=True)
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+
+        for worker in self.workers:
+            print(f"[supervisor] Shard {worker.shard} restarted {worker.restarts} times", file=sys.stderr)
+
+def run(args, argv, bot_descs):
+    """
+    Run the bots of bot_descs sharded across args.shards worker processes running main.py with argv.
+    """
+    asyncio.run(Supervisor(args, argv, bot_descs).run())
@@ -0,0 +1,137 @@
+"""
+Sampled span tracing of the messages and replies of the bots, exported as Chrome trace-event JSON
+(open it in https://ui.perfetto.dev or chrome://tracing).
+
+- Every message received by a MessageMonitor gets a "message" trace on the lane of its room, from
+  its timestamp to the poll that received it.
+- Every reply gets a "reply" trace on the lane of its bot, from the moment it starts reading to the
+  echo of its message (or the abort), with spans for reading, the LLM call (queue and requests per
+  model), writing and waiting for the echo.
+
+Only TRACE_SAMPLE_RATE of the traces are recorded, and finished traces are kept in a ring buffer
+of TRACE_BUFFER_SIZE, so tracing costs nothing when disabled and stays bounded when enabled.
+Spans are attached to the trace of the current task (see set_current), so callers deep in the
+LLM client do not need to pass it around.
+"""
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import random
+from collections import deque
+
+import clock
+
+TRACE_SAMPLE_RATE = 0.0     # Fraction of the messages and replies traced, --trace_sample
+TRACE_BUFFER_SIZE = 10000   # Finished traces kept in memory, the oldest ones are dropped
+
+_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+_ids = itertools.count(1)
+_lanes: dict[str, int] = {}
+_current = contextvars.ContextVar("current_trace", default=None)
+
+def to_us(timestamp):
+    return int(timestamp * 1_000_000)
+
+def get_lane_id(lane):
+    if lane not in _lanes:
+        _lanes[lane] = len(_lanes) + 1
+    return _lanes[lane]
+
+class Trace:
+    def __init__(self, kind, lane, start_time=None, **args):
+        self.kind = kind
+        self.id = next(_ids)
+        self.lane = lane
+        self.start_time = clock.now() if start_time is None else start_time
+        self.args = args
+        self.spans = []         # (name, start_time, end_time, args)
+        self.open_spans = {}    # name -> (start_time, args) of spans started with begin()
+        self.finished = False
+
+    def add_span(self, name, start_time, end_time, **args):
+        self.spans.append((name, start_time, end_time, args))
+
+    def begin(self, name, **args):
+        self.open_spans[name] = (clock.now(), args)
+
+    def end(self, name, end_time=None):
+        if name in self.open_spans:
+            start_time, args = self.open_spans.pop(name)
+            self.add_span(name, start_time, clock.now() if end_time is None else end_time, **args)
+
+    def finish(self, end_time=None, **args):
+        if self.finished:
+            return
+        self.finished = True
+        end_time = clock.now() if end_time is None else end_time
+        for name in list(self.open_spans):
+            self.end(name, end_time)
+        self.args.update(args)
+        self.end_time = end_time
+        _buffer.append(self)
+
+    def to_events(self, pid):
+        common = {"cat": self.kind, "id": self.id, "pid": pid, "tid": get_lane_id(self.lane)}
+        events = [
+            dict(common, name=self.kind, ph="b", ts=to_us(self.start_time), args=self.args),
+            dict(common, name=self.kind, ph="e", ts=to_us(self.end_time)),
+        ]
+        for name, start_time, end_time, args in self.spans:
+            events.append(dict(common, name=name, ph="b", ts=to_us(start_time), args=args))
+            events.append(dict(common, name=name, ph="e", ts=to_us(end_time)))
+        return events
+
+def start_trace(kind, lane, start_time=None, **args):
+    """
+    Returns a new trace, or None if it is not sampled. Every method accepting a trace accepts None.
+    """
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    return Trace(kind, lane, start_time, **args)
+
+def set_current(trace):
+    """
+    Make trace the trace of the current task (and of the tasks it creates from now on).
+    """
+    _current.set(trace)
+
+@contextlib.contextmanager
+def _span(trace, name, args):
+    start_time = clock.now()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start_time, clock.now(), **args)
+
+_no_span = contextlib.nullcontext()
+
+def span(name, trace=None, **args):
+    """
+    Context manager recording a span in trace, by default the trace of the current task.
+    """
+    trace = trace or _current.get()
+    if trace is None or trace.finished:
+        return _no_span
+    return _span(trace, name, args)
+
+def get_events():
+    pid = os.getpid()
+    events = [event for trace in list(_buffer) for event in trace.to_events(pid)]
+    # Name the lanes after their bot or room
+    events.extend({"name": "thread_name", "ph": "M", "pid": pid, "tid": lane_id, "args": {"name": lane}}
+                  for lane, lane_id in _lanes.items())
+    return events
+
+def export(filename):
+    """
+    Write the traces in the buffer as Chrome trace-event JSON. Returns the number of traces.
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    traces = len(_buffer)
+    with open(filename, 'w') as file:
+        json.dump({"traceEvents": get_events(), "displayTimeUnit": "ms"}, file)
+    return traces
@@ -1,10 +1,16 @@
 import asyncio
+import atexit
 from dotenv import load_dotenv
+import gzip
 import json
 import logging
+import logging.handlers
 import os
+import queue
 import re
+import shutil
 import sys
+import threading
 
 from constants import *
 
@@ -35,6 +41,17 @@ def read_file_text(filepath):
     with open(filepath, 'r') as file:
         return file.read()
 
+def write_json_atomic(filename, data):
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file first, so readers never see a partial file (one per writer, as a
+    # checkpoint may be written from a thread and the event loop at once)
+    tmp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_filename, filename)
+
 def get_api_key(name):
     return os.getenv(f"{name.upper()}_API_KEY")
 
@@ -47,7 +64,7 @@ def build_message(role, content, name=None):
 
 async def bot_sleep(time_s, logger=None):
     if logger:
-        logger.info(f'Going to sleep for {time_s/SPEED_UP_FACTOR}s')
+        logger.info('Going to sleep for %ss', time_s/SPEED_UP_FACTOR)
     await asyncio.sleep(time_s/SPEED_UP_FACTOR)
 
 def get_reading_time(message_len: int):
@@ -56,11 +73,106 @@ def get_reading_time(message_len: int):
 def get_writing_time(message):
     return (len(message)/WRITE_SPEED)/SPEED_UP_FACTOR
 
+def summarize(values):
+    """
+    Count, mean, percentiles and max of a list of numbers, for reports.
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def percentile(q):
+        return values[min(len(values) - 1, int(len(values) * q / 100))]
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": values[-1],
+    }
+
+LOG_MAX_BYTES = 10 * 1024 * 1024   # Size at which a log file is rotated
+LOG_BACKUP_COUNT = 5                # Rotated (gzipped) log files kept per log
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting of the message to the listener thread.
+    Only the traceback is formatted here, as it refers to frames that are about to change.
+    Arguments of log calls must not be mutated after logging them.
+    """
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+class LoggerRouter(logging.Handler):
+    """
+    Handler of the listener thread sending each record to the handlers of its logger.
+    """
+    def __init__(self):
+        super().__init__()
+        self.handlers = {}
+
+    def add(self, name, *handlers):
+        self.handlers.setdefault(name, []).extend(handlers)
+
+    def handle(self, record):
+        for handler in self.handlers.get(record.name, []):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+def gzip_namer(name):
+    return name + '.gz'
+
+def gzip_rotator(source, destination):
+    with open(source, 'rb') as source_file, gzip.open(destination, 'wb') as destination_file:
+        shutil.copyfileobj(source_file, destination_file)
+    os.remove(source)
+
+def get_rotating_file_handler(filename, level):
+    # delay opens the file in the listener thread, on the first record
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True)
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    handler.setLevel(level)
+    return handler
+
+log_queue = None
+log_router = None
+log_listener = None
+
+def start_log_listener():
+    """
+    Start the thread writing every log record, so logging never blocks the event loop.
+    """
+    global log_queue, log_router, log_listener
+    if log_listener is None:
+        log_queue = queue.SimpleQueue()
+        log_router = LoggerRouter()
+        log_listener = logging.handlers.QueueListener(log_queue, log_router)
+        log_listener.start()
+        atexit.register(stop_log_listener)
+
+def stop_log_listener():
+    """
+    Write the records still in the queue and stop the listener thread.
+    """
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
 # Set up logging
 def get_logger(name):
-    # Create a custom logger
+    # Create a custom logger, its records are written by the listener thread
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
+    start_log_listener()
+
+    # Already set up, e.g. for a bot restarted by a reload of the experiment description
+    if name in log_router.handlers:
+        return logger
 
     # Create handlers
     console_handler = logging.StreamHandler(sys.stdout)
@@ -68,17 +180,13 @@ def get_logger(name):
 
     # Ensure the output/logs directory exists
     log_directory = 'output/logs'
-    if not os.path.exists(log_directory):
-        os.makedirs(log_directory)
-    file_info_handler = logging.FileHandler(f'{log_directory}/{name}.log')
-    file_info_handler.setLevel(logging.DEBUG)
+    os.makedirs(log_directory, exist_ok=True)
+    file_info_handler = get_rotating_file_handler(f'{log_directory}/{name}.log', logging.DEBUG)
 
     # Ensure the output/error_logs directory exists
     log_directory = 'output/error_logs'
-    if not os.path.exists(log_directory):
-        os.makedirs(log_directory)
-    file_error_handler = logging.FileHandler(f'{log_directory}/{name}.log')
-    file_error_handler.setLevel(logging.ERROR)
+    os.makedirs(log_directory, exist_ok=True)
+    file_error_handler = get_rotating_file_handler(f'{log_directory}/{name}.log', logging.ERROR)
 
     # Create formatters and add them to handlers
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -86,9 +194,8 @@ def get_logger(name):
     file_info_handler.setFormatter(formatter)
     file_error_handler.setFormatter(formatter)
 
-    # Add handlers to the logger
-    logger.addHandler(console_handler)
-    logger.addHandler(file_info_handler)
-    logger.addHandler(file_error_handler)
+    # Add handlers to the listener and the queue handler to the logger
+    log_router.add(name, console_handler, file_info_handler, file_error_handler)
+    logger.addHandler(LazyQueueHandler(log_queue))
 
     return logger